@@ -0,0 +1,129 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_airtable import FakeAirtable, build_shipment_group
+from fake_s3 import FakeS3Client
+from run import BUCKET_NAME, SHIPMENT_GROUP_ID, git_commit, parse_size
+
+# Cold and warm start report of the create function. Every mode runs in a fresh process that imports
+# handler, creates the S3 client and then calls create() repeatedly against the local fake Airtable:
+#
+#   python benchmarks/cold_start.py --modes lazy prewarm --output cold-start.json
+#
+# lazy imports everything on first use, prewarm sets PREWARM=true so the imports and clients are set up
+# while the module loads (the Lambda init phase). The S3 client is a real boto3 client, so its creation
+# is measured, but the requests are then served by the in-memory stand-in.
+
+
+def run_mode(connection, api_url, mode, invocations):
+    os.environ.update(
+        AIRTABLE_APP_ID='appBenchmark',
+        AIRTABLE_SECRET_KEY='keyBenchmark',
+        BUCKET_NAME=BUCKET_NAME,
+        METRICS_FORMAT='json',
+        PREWARM='true' if mode == 'prewarm' else 'false'
+    )
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    try:
+        # the fake Airtable url has to be in place before a prewarm creates the tables
+        start = time.monotonic()
+        import airtable
+        airtable.Airtable.API_URL = api_url
+        airtable_import_ms = (time.monotonic() - start) * 1000
+
+        start = time.monotonic()
+        with redirect_stdout(StringIO()):
+            import clients
+            import handler
+        init_ms = (time.monotonic() - start) * 1000
+
+        start = time.monotonic()
+        clients.aws_client('s3')
+        s3_client_ms = (time.monotonic() - start) * 1000
+        clients.aws_clients['s3'] = FakeS3Client()
+
+        event = {'body': json.dumps({'recordId': SHIPMENT_GROUP_ID, 'force': True})}
+        invocation_ms = []
+        for invocation in range(invocations):
+            start = time.monotonic()
+            with redirect_stdout(StringIO()):
+                response = handler.create(event, None)
+            invocation_ms.append(round((time.monotonic() - start) * 1000, 1))
+            if response['statusCode'] != 200:
+                raise ValueError(response['body'])
+
+        connection.send({
+            'mode': mode,
+            'airtable_import_ms': round(airtable_import_ms, 1),
+            'init_ms': round(init_ms, 1),
+            's3_client_ms': round(s3_client_ms, 1),
+            'invocation_ms': invocation_ms,
+            # time to the first response of a new container, init included
+            'cold_start_ms': round(airtable_import_ms + init_ms + s3_client_ms + invocation_ms[0], 1),
+            'warm_start_ms': statistics.median(invocation_ms[1:]) if len(invocation_ms) > 1 else None
+        })
+    except Exception as e:
+        connection.send({'mode': mode, 'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold and warm start report of the create function.')
+    parser.add_argument('--modes', nargs='+', default=['lazy', 'prewarm'], choices=['lazy', 'prewarm'])
+    parser.add_argument('--size', default='10x10', help='<shipments>x<line items per shipment>')
+    parser.add_argument('--invocations', type=int, default=5, help='create calls per process, the first one is cold')
+    parser.add_argument('--latency', type=float, default=0.05, help='Airtable response latency in seconds')
+    parser.add_argument('--output', default='cold-start.json', help='results file')
+    args = parser.parse_args()
+
+    domestic_shipments, line_items = parse_size(args.size)
+    fake = FakeAirtable(build_shipment_group(domestic_shipments, line_items, record_id=SHIPMENT_GROUP_ID), latency=args.latency, rate_limit=0).start()
+    report = {
+        'commit': git_commit(),
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'size': args.size, 'invocations': args.invocations, 'latency': args.latency},
+        'results': []
+    }
+    context = multiprocessing.get_context('spawn')
+    try:
+        for mode in args.modes:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_mode, args=(sender, fake.url, mode, args.invocations))
+            process.start()
+            sender.close()
+            result = receiver.recv()
+            process.join()
+            report['results'].append(result)
+            if 'error' in result:
+                print('{:>8} failed: {}'.format(mode, result['error']))
+            else:
+                print('{:>8}  init {:>7} ms  s3 client {:>7} ms  first request {:>7} ms  cold start {:>7} ms  warm start {:>7} ms'.format(
+                    mode, round(result['airtable_import_ms'] + result['init_ms'], 1), result['s3_client_ms'],
+                    result['invocation_ms'][0], result['cold_start_ms'], result['warm_start_ms']))
+    finally:
+        fake.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nresults written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# A local stand-in for the Airtable REST API, just enough of it for the packing list pipeline:
+# record gets, list requests with RECORD_ID() and LAST_MODIFIED_TIME() formulas, fields[] projection,
+# pagination, single and batch PATCH updates. Every request can be delayed by a fixed latency plus
+# jitter, and requests above the per base rate limit are answered with a 429 like Airtable does.
+
+PAGE_SIZE = 100
+
+
+def timestamp(seconds):
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def build_shipment_group(domestic_shipments=10, line_items=10, skus=500, facilities=20, seed=1, record_id='recShipmentGroup'):
+    """Synthetic base with one ShipmentGroup of domestic_shipments shipments with line_items line items each."""
+    rnd = random.Random(seed)
+    skus = min(skus, domestic_shipments * line_items)
+    tables = {
+        'ShipmentGroup': {},
+        'Domestic Shipments': {},
+        'DomesticShipmentLineItem': {},
+        'SKUS': {},
+        'PackagingProfile': {},
+        'FCList': {}
+    }
+    for i in range(skus):
+        tables['SKUS']['recSku%d' % i] = {
+            'SKU': 'SKU-%05d' % i,
+            'FNSKU': 'X00%07d' % i,
+            'Description': 'Synthetic product %d ' % i + 'lorem ipsum ' * 20
+        }
+        tables['PackagingProfile']['recProfile%d' % i] = {
+            'UnitsPerCarton': rnd.choice((6, 12, 24, 48)),
+            'CartonLengthCM': rnd.randrange(30, 70),
+            'CartonWidthCM': rnd.randrange(20, 50),
+            'CartonHeightCM': rnd.randrange(15, 45),
+            'CartonWeightKG': round(rnd.uniform(2, 20), 2)
+        }
+    for i in range(facilities):
+        tables['FCList']['recFacility%d' % i] = {
+            'FCID': 'FC%02d' % i,
+            'FCAddress': '%d Warehouse Road, Suite %d, Fulfillment City, ST %05d' % (i + 1, i, 10000 + i),
+            'FacilityCountry': 'US'
+        }
+    shipment_ids = []
+    for s in range(domestic_shipments):
+        line_item_ids = []
+        for j in range(line_items):
+            line_item_id = 'recLineItem%d_%d' % (s, j)
+            sku = rnd.randrange(skus)
+            tables['DomesticShipmentLineItem'][line_item_id] = {
+                'SKU': ['recSku%d' % sku],
+                'PackagingProfile': ['recProfile%d' % sku],
+                'CaseQty': rnd.randrange(1, 40),
+                'ShipQuantity': rnd.randrange(10, 2000),
+                'BoxMark': 'BM-%d-%d' % (s, j),
+                'Notes': 'lorem ipsum ' * 10
+            }
+            line_item_ids.append(line_item_id)
+        shipment_id = 'recShipment%d' % s
+        tables['Domestic Shipments'][shipment_id] = {
+            'FCID': ['recFacility%d' % rnd.randrange(facilities)],
+            'LineItems': line_item_ids,
+            'FBA Shipment ID': 'FBA%08d' % s,
+            'AMZReferenceID': 'REF%06d' % s
+        }
+        shipment_ids.append(shipment_id)
+    tables['ShipmentGroup'][record_id] = {
+        'DomesticShipments': shipment_ids,
+        'Cosignee Name': 'Synthetic Cosignee Ltd.',
+        'PackingLists Generated': []
+    }
+    return tables
+
+
+class FakeAirtable(object):
+    def __init__(self, tables=None, latency=0.0, jitter=0.0, rate_limit=5, retry_after=1):
+        # tables maps table name -> record id -> fields, latency and jitter are in seconds,
+        # rate_limit is the allowed requests per second per base (0 disables it)
+        self.records = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.requests = Counter()
+        self.throttled = 0
+        self.server = None
+        self.load(tables or {})
+
+    def load(self, tables, modified=None):
+        # modified is the last modified time of the loaded records, now by default
+        with self.lock:
+            modified = time.time() if modified is None else modified
+            self.records = {
+                table_name: {record_id: {'fields': fields, 'modified': modified} for record_id, fields in records.items()}
+                for table_name, records in tables.items()
+            }
+
+    def update(self, table_name, record_id, fields):
+        # change a record the way someone editing the base would
+        with self.lock:
+            record = self.records[table_name][record_id]
+            record['fields'].update(fields)
+            record['modified'] = time.time()
+            return self.as_record(record_id, record)
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = Counter()
+            self.throttled = 0
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/v0'.format(*self.server.server_address[:2])
+
+    def allow(self, base):
+        # sliding one second window per base
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            window = self.recent.setdefault(base, deque())
+            now = time.monotonic()
+            while window and window[0] <= now - 1:
+                window.popleft()
+            if len(window) >= self.rate_limit:
+                self.throttled += 1
+                return False
+            window.append(now)
+            return True
+
+    def as_record(self, record_id, record, fields=None):
+        return {
+            'id': record_id,
+            'createdTime': timestamp(record['modified']),
+            'fields': {name: value for name, value in record['fields'].items() if not fields or name in fields}
+        }
+
+    def list_records(self, table_name, query):
+        formula = query.get('filterByFormula', [''])[0]
+        fields = query.get('fields[]')
+        with self.lock:
+            table = self.records.get(table_name, {})
+            if 'RECORD_ID()' in formula:
+                record_ids = re.findall(r"RECORD_ID\(\)='([^']+)'", formula)
+                selected = [(record_id, table[record_id]) for record_id in record_ids if record_id in table]
+            elif 'LAST_MODIFIED_TIME()' in formula:
+                since = re.search(r"IS_AFTER\(LAST_MODIFIED_TIME\(\),'([^']+)'\)", formula).group(1)
+                selected = [(record_id, record) for record_id, record in table.items() if timestamp(record['modified']) > since]
+            else:
+                selected = list(table.items())
+            records = [self.as_record(record_id, record, fields) for record_id, record in selected]
+        if 'maxRecords' in query:
+            records = records[:int(query['maxRecords'][0])]
+        offset = int(query.get('offset', ['0'])[0])
+        page_size = min(int(query.get('pageSize', [PAGE_SIZE])[0]), PAGE_SIZE)
+        page = {'records': records[offset:offset + page_size]}
+        if offset + page_size < len(records):
+            page['offset'] = str(offset + page_size)
+        return page
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def route(self, method):
+                url = urlparse(self.path)
+                path = [unquote(part) for part in url.path.split('/')[2:]]
+                body = None
+                if 'Content-Length' in self.headers:
+                    body = self.rfile.read(int(self.headers['Content-Length']))
+                if len(path) < 2:
+                    return self.respond(404, {'error': 'NOT_FOUND'})
+                base, table_name = path[0], path[1]
+                record_id = path[2] if len(path) > 2 else None
+
+                time.sleep(max(0.0, fake.latency + random.uniform(-fake.jitter, fake.jitter)))
+                if not fake.allow(base):
+                    return self.respond(429, {'errors': [{'error': 'RATE_LIMIT_REACHED'}]}, {'Retry-After': str(fake.retry_after)})
+                with fake.lock:
+                    fake.requests[method + ' ' + table_name] += 1
+                    exists = table_name in fake.records and (record_id is None or record_id in fake.records[table_name])
+                if not exists:
+                    return self.respond(404, {'error': 'NOT_FOUND'})
+
+                if method == 'GET' and record_id:
+                    with fake.lock:
+                        record = fake.as_record(record_id, fake.records[table_name][record_id])
+                    return self.respond(200, record)
+                if method == 'GET':
+                    return self.respond(200, fake.list_records(table_name, parse_qs(url.query)))
+                body = json.loads(body or b'{}')
+                try:
+                    if record_id:
+                        return self.respond(200, fake.update(table_name, record_id, body['fields']))
+                    if len(body['records']) > 10:
+                        return self.respond(422, {'error': {'type': 'INVALID_RECORDS', 'message': 'at most 10 records per request'}})
+                    return self.respond(200, {'records': [fake.update(table_name, record['id'], record['fields']) for record in body['records']]})
+                except KeyError:
+                    return self.respond(404, {'error': 'NOT_FOUND'})
+
+            def do_GET(self):
+                self.route('GET')
+
+            def do_PATCH(self):
+                self.route('PATCH')
+
+        return Handler
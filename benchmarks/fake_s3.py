@@ -0,0 +1,102 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# An in-memory stand-in for the boto3 S3 client, covering the calls handler.py makes: put_object,
+# get_object, list_objects_v2 and the multipart upload calls. latency (seconds) is added to every call.
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class Exceptions(object):
+    NoSuchKey = NoSuchKey
+
+
+class Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3Client(object):
+    exceptions = Exceptions
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        # last modified time of every object
+        self.modified = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.call()
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+            self.modified[(Bucket, Key)] = time.time()
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.call()
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise NoSuchKey(Key)
+            return {'Body': Body(self.objects[(Bucket, Key)])}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+        # the continuation token is the last key of the previous page
+        self.call()
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix) and key > (ContinuationToken or ''))
+            contents = [{
+                'Key': key,
+                'LastModified': datetime.fromtimestamp(self.modified[(Bucket, key)], timezone.utc),
+                'Size': len(self.objects[(Bucket, key)])
+            } for key in keys[:MaxKeys]]
+        response = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = contents[-1]['Key']
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.call()
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId, **kwargs):
+        self.call()
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': '"{}-{}"'.format(UploadId, PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.call()
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+            self.modified[(Bucket, Key)] = time.time()
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.call()
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def size(self, bucket, key):
+        with self.lock:
+            return len(self.objects[(bucket, key)])
@@ -0,0 +1,195 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_airtable import FakeAirtable, build_shipment_group
+from fake_s3 import FakeS3Client
+
+# Benchmarks the packing list pipeline end to end against a local fake Airtable server and an
+# in-memory S3 client, for synthetic shipment groups of several sizes:
+#
+#   python benchmarks/run.py --sizes 1x10 10x10 200x100 --output benchmark.json
+#   python benchmarks/run.py --compare benchmark.json
+#
+# Every size runs in a fresh process, so the peak RSS and the reference cache are its own.
+# Sizes are <domestic shipments>x<line items per shipment>.
+
+DEFAULT_SIZES = ['1x10', '10x10', '50x50', '100x100', '200x100']
+SHIPMENT_GROUP_ID = 'recShipmentGroup'
+BUCKET_NAME = 'benchmark-packing-lists'
+
+
+def parse_size(size):
+    domestic_shipments, line_items = size.lower().split('x')
+    return int(domestic_shipments), int(line_items)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(connection, api_url, repeat, s3_latency, output_format):
+    # runs in its own process: generate the packing list repeat times, the first run is cold
+    os.environ.update(
+        AIRTABLE_APP_ID='appBenchmark',
+        AIRTABLE_SECRET_KEY='keyBenchmark',
+        BUCKET_NAME=BUCKET_NAME,
+        METRICS_FORMAT='json'
+    )
+    try:
+        import airtable
+        import handler
+
+        airtable.Airtable.API_URL = api_url
+        s3_client = FakeS3Client(latency=s3_latency)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        runs = []
+        for run in range(repeat):
+            handler.metrics.reset()
+            start = time.monotonic()
+            with redirect_stdout(io.StringIO()):
+                download, reused = handler.generate_packaging_list(s3_client, SHIPMENT_GROUP_ID, force=True, output_format=output_format)
+            wall = (time.monotonic() - start) * 1000
+            data = handler.metrics.as_dict()
+            runs.append({
+                'run': run,
+                'wall_ms': round(wall, 1),
+                'fetch_ms': data['timings_ms'].get('fetch'),
+                'render_ms': data['timings_ms'].get('render'),
+                'upload_ms': data['timings_ms'].get('upload'),
+                'attach_ms': data['timings_ms'].get('attach'),
+                'airtable_requests': data['counters'].get('airtable_requests', 0),
+                'airtable_retries': data['counters'].get('airtable_retries', 0),
+                'airtable_throttle_ms': data['counters'].get('airtable_throttle_ms', 0),
+                'airtable_bytes': data['counters'].get('airtable_bytes', 0),
+                'rows_written': data['counters'].get('rows_written'),
+                'cells_written': data['counters'].get('cells_written'),
+                'output_bytes': s3_client.size(BUCKET_NAME, download.rsplit('/', 1)[1]),
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            })
+        connection.send({'rss_before_kb': rss_before, 'runs': runs})
+    except Exception as e:
+        connection.send({'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        connection.close()
+
+
+def benchmark(fake, size, repeat, s3_latency, output_format):
+    domestic_shipments, line_items = parse_size(size)
+    fake.load(build_shipment_group(domestic_shipments, line_items, record_id=SHIPMENT_GROUP_ID))
+    fake.reset_counters()
+    # every size runs in a process of its own, with a rate limiter of its own: the requests of the previous
+    # size have to leave the one second window of the fake first
+    time.sleep(1)
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(sender, fake.url, repeat, s3_latency, output_format))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+
+    result.update(
+        size=size,
+        domestic_shipments=domestic_shipments,
+        line_items=domestic_shipments * line_items,
+        server_requests=dict(fake.requests),
+        server_throttled=fake.throttled
+    )
+    return result
+
+
+def compare(results, baseline):
+    # relative change of the cold run of every size against a previous results file
+    previous = {result['size']: result for result in baseline['results'] if 'runs' in result}
+    print('\ncompared to {} ({})'.format(baseline.get('commit'), baseline.get('started')))
+    for result in results:
+        if 'runs' not in result or result['size'] not in previous:
+            continue
+        current, before = result['runs'][0], previous[result['size']]['runs'][0]
+        changes = []
+        for name in ('wall_ms', 'fetch_ms', 'render_ms', 'peak_rss_kb', 'airtable_requests', 'output_bytes'):
+            if current.get(name) is not None and before.get(name):
+                changes.append('{} {:+.1f}%'.format(name, (current[name] - before[name]) * 100.0 / before[name]))
+        print('{:>8}  {}'.format(result['size'], '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark packing list generation against a local fake Airtable.')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='<shipments>x<line items per shipment>')
+    parser.add_argument('--latency', type=float, default=0.1, help='Airtable response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05, help='random +- latency in seconds')
+    parser.add_argument('--rate-limit', type=int, default=5, help='Airtable requests per second per base, 0 for none')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds of throttled requests')
+    parser.add_argument('--s3-latency', type=float, default=0.0, help='latency of every S3 call in seconds')
+    parser.add_argument('--format', default='xlsx', help='output format, xlsx, csv, jsonl or parquet')
+    parser.add_argument('--repeat', type=int, default=2, help='runs per size, the first one starts cold')
+    parser.add_argument('--output', default='benchmark.json', help='results file')
+    parser.add_argument('--compare', help='previous results file to compare with')
+    args = parser.parse_args()
+
+    fake = FakeAirtable(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, retry_after=args.retry_after).start()
+    report = {
+        'commit': git_commit(),
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'rate_limit': args.rate_limit,
+            'retry_after': args.retry_after,
+            's3_latency': args.s3_latency,
+            'format': args.format,
+            'repeat': args.repeat
+        },
+        'results': []
+    }
+    print('{:>8} {:>4} {:>10} {:>10} {:>10} {:>12} {:>9} {:>11}'.format(
+        'size', 'run', 'wall ms', 'fetch ms', 'render ms', 'peak rss kb', 'requests', 'output b'))
+    try:
+        for size in args.sizes:
+            result = benchmark(fake, size, args.repeat, args.s3_latency, args.format)
+            report['results'].append(result)
+            if 'error' in result:
+                print('{:>8} failed: {}'.format(size, result['error']))
+                continue
+            for run in result['runs']:
+                print('{:>8} {:>4} {:>10} {:>10} {:>10} {:>12} {:>9} {:>11}'.format(
+                    size, run['run'], run['wall_ms'], run['fetch_ms'], run['render_ms'],
+                    run['peak_rss_kb'], run['airtable_requests'], run['output_bytes']))
+    finally:
+        fake.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nresults written to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+
+
+if __name__ == '__main__':
+    main()
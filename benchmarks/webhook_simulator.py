@@ -0,0 +1,161 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_airtable import FakeAirtable, build_shipment_group
+from fake_s3 import FakeS3Client
+from run import BUCKET_NAME, SHIPMENT_GROUP_ID, git_commit, parse_size
+
+# Simulates Airtable change notifications against the local fake Airtable, to compare how long create
+# takes after a line item was edited with and without pre-generation:
+#
+#   python benchmarks/webhook_simulator.py --size 50x50 --output webhook.json
+#
+# direct: the line item is edited and create regenerates the packing list itself.
+# pregenerated: the line item is edited, a signed notification is sent to airtable_webhook, the queued
+# job is processed and create then only has to check that the packing list is current. The simulation
+# fails if it fetches the group instead.
+
+APP_ID = 'appBenchmark'
+LINE_ITEM_ID = 'recLineItem0_0'
+
+
+def signed_notification(secret):
+    # a notification the way Airtable sends it, the payloads are left to the poll
+    body = json.dumps({
+        'base': {'id': APP_ID},
+        'webhook': {'id': 'achBenchmark'},
+        'timestamp': datetime.utcnow().isoformat() + 'Z'
+    })
+    signature = hmac.new(base64.b64decode(secret), body.encode('utf-8'), hashlib.sha256).hexdigest()
+    return {
+        'headers': {'Content-Type': 'application/json', 'X-Airtable-Content-MAC': 'hmac-sha256=' + signature},
+        'body': body
+    }
+
+
+def timed(func, *args):
+    start = time.monotonic()
+    with redirect_stdout(StringIO()):
+        result = func(*args)
+    return result, round((time.monotonic() - start) * 1000, 1)
+
+
+def create(handler):
+    response, wall_ms = timed(handler.create, {'body': json.dumps({'recordId': SHIPMENT_GROUP_ID, 'debug': True})}, None)
+    if response['statusCode'] != 200:
+        raise ValueError(response['body'])
+    result = json.loads(response['body'])
+    result['stages'] = list(result.pop('debug')['timings_ms'])
+    return result, wall_ms
+
+
+def edit_line_item(fake, edit):
+    fake.update('DomesticShipmentLineItem', LINE_ITEM_ID, {'ShipQuantity': 100 + edit})
+    # past the clock skew margin of the precheck, so the edit is no longer within it
+    time.sleep(1.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare create after an edit with and without webhook-driven pre-generation.')
+    parser.add_argument('--size', default='10x10', help='<shipments>x<line items per shipment>')
+    parser.add_argument('--latency', type=float, default=0.1, help='Airtable response latency in seconds')
+    parser.add_argument('--rate-limit', type=int, default=5, help='Airtable requests per second per base, 0 for none')
+    parser.add_argument('--output', default='webhook.json', help='results file')
+    args = parser.parse_args()
+
+    secret = base64.b64encode(os.urandom(32)).decode('ascii')
+    os.environ.update(
+        AIRTABLE_APP_ID=APP_ID,
+        AIRTABLE_SECRET_KEY='keyBenchmark',
+        AIRTABLE_WEBHOOK_SECRET=secret,
+        BUCKET_NAME=BUCKET_NAME,
+        CLOCK_SKEW_MARGIN='1',
+        JOB_QUEUE='memory',
+        JOB_STORE='memory',
+        LEASE_STORE='memory',
+        METRICS_FORMAT='json'
+    )
+    import airtable
+    import clients
+    import handler
+
+    domestic_shipments, line_items = parse_size(args.size)
+    fake = FakeAirtable(latency=args.latency, rate_limit=args.rate_limit).start()
+    # the base was last edited well before the simulation starts
+    fake.load(build_shipment_group(domestic_shipments, line_items, record_id=SHIPMENT_GROUP_ID), modified=time.time() - 3600)
+    airtable.Airtable.API_URL = fake.url
+    clients.aws_clients['s3'] = FakeS3Client()
+
+    report = {
+        'commit': git_commit(),
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'size': args.size, 'latency': args.latency, 'rate_limit': args.rate_limit},
+        'results': {}
+    }
+    try:
+        _, report['results']['first_create_ms'] = create(handler)
+        # the first poll starts the change feed
+        _, report['results']['initial_poll_ms'] = timed(handler.poll_changes, {}, None)
+
+        edit_line_item(fake, 1)
+        result, wall_ms = create(handler)
+        report['results']['direct'] = {'create_ms': wall_ms, 'reused': result['reused']}
+        # the regeneration above is seen by the next poll too, start the comparison after it
+        timed(handler.poll_changes, {}, None)
+        timed(handler.process_jobs, {}, None)
+
+        edit_line_item(fake, 2)
+        response, webhook_ms = timed(handler.airtable_webhook, signed_notification(secret), None)
+        if response['statusCode'] != 200:
+            raise ValueError(response['body'])
+        webhook = json.loads(response['body'])
+        _, jobs_ms = timed(handler.process_jobs, {}, None)
+        result, wall_ms = create(handler)
+        report['results']['pregenerated'] = {
+            'webhook_ms': webhook_ms,
+            'queued': webhook['queued'],
+            'jobs_ms': jobs_ms,
+            'create_ms': wall_ms,
+            'reused': result['reused'],
+            'stages': result['stages']
+        }
+        # the job kept the packing list current, create only has to check that
+        if not result['reused'] or 'fetch' in result['stages']:
+            raise ValueError('The pre-generated packing list was not reused after the precheck: {}'.format(result['stages']))
+
+        # a notification with a bad signature is rejected
+        notification = signed_notification(base64.b64encode(os.urandom(32)).decode('ascii'))
+        response, _ = timed(handler.airtable_webhook, notification, None)
+        report['results']['bad_signature_status'] = response['statusCode']
+    finally:
+        fake.stop()
+
+    results = report['results']
+    print('direct        create {:>9} ms  reused {}'.format(results['direct']['create_ms'], results['direct']['reused']))
+    print('pregenerated  create {:>9} ms  reused {}  (webhook {} ms, {} jobs queued, processed in {} ms)'.format(
+        results['pregenerated']['create_ms'], results['pregenerated']['reused'], results['pregenerated']['webhook_ms'],
+        len(results['pregenerated']['queued']), results['pregenerated']['jobs_ms']))
+    print('bad signature status {}'.format(results['bad_signature_status']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nresults written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import threading
+
+# AWS clients are created once per container and reused by every warm invocation, so the import of
+# boto3, the client setup and the pooled connections are paid for only on a cold start.
+
+AWS_MAX_POOL_CONNECTIONS = 32
+
+aws_clients = {}
+aws_clients_lock = threading.Lock()
+
+def aws_client(service_name):
+    client = aws_clients.get(service_name)
+    if client is None:
+        with aws_clients_lock:
+            client = aws_clients.get(service_name)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+
+                client = aws_clients[service_name] = boto3.client(service_name, config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS))
+    return client
@@ -0,0 +1,188 @@
+import csv
+import json
+from importlib.util import find_spec
+from io import StringIO
+
+# Machine-readable exports of the packing list content, written straight from the ShipmentGroup model
+# without xlsxwriter. Every format is a stream of flat rows sharing the EXPORT_COLUMNS schema:
+#   shipment   one per domestic shipment with its header fields and totals
+#   line_item  the line items of the shipment before them, with computed KG and CBM
+#   sku        the SKU summary, units and cases per SKU over the whole group
+#   total      the grand totals of the group
+# Shipments and their line items are written as they are produced, only the summary rows, which need
+# the whole group, come at the end.
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+EXPORT_COLUMNS = (
+    ('record_type', 'string'),
+    ('shipment_id', 'string'),
+    ('reference_id', 'string'),
+    ('fulfillment_center', 'string'),
+    ('ship_to', 'string'),
+    ('address', 'string'),
+    ('country', 'string'),
+    ('sku', 'string'),
+    ('fnsku', 'string'),
+    ('units_per_case', 'number'),
+    ('cases', 'number'),
+    ('units', 'number'),
+    ('kg', 'number'),
+    ('cbm', 'number'),
+    ('length_cm', 'number'),
+    ('width_cm', 'number'),
+    ('height_cm', 'number'),
+    ('carton_cbm', 'number'),
+    ('weight_per_case_kg', 'number'),
+    ('box_mark', 'string')
+)
+
+# rows buffered before they are encoded and written to the output
+EXPORT_BATCH_SIZE = 5000
+
+
+def number(value):
+    # numeric cells as numbers, blank or non-numeric ones as missing
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def text(value):
+    return None if value is None or value == '' else str(value)
+
+
+def export_rows(shipment_group, domestic_shipments, summary):
+    # yields the rows of the aggregated domestic_shipments of a shipment group, summary is only read
+    # after the last of them, so it can be aggregated while they are iterated
+    for domestic_shipment in domestic_shipments:
+        fulfillment_center = domestic_shipment.fulfillment_center
+        yield {
+            'record_type': 'shipment',
+            'shipment_id': text(domestic_shipment.fba_shipment_id),
+            'reference_id': text(domestic_shipment.amz_reference_id),
+            'fulfillment_center': text(fulfillment_center.fcid),
+            'ship_to': text(shipment_group.cosignee),
+            'address': text(fulfillment_center.address),
+            'country': text(fulfillment_center.country),
+            'cases': domestic_shipment.totals['cases'],
+            'units': domestic_shipment.totals['units'],
+            'kg': domestic_shipment.totals['kg'],
+            'cbm': domestic_shipment.totals['cbm']
+        }
+        for line_item in domestic_shipment.line_items:
+            packaging_profile = line_item.packaging_profile
+            yield {
+                'record_type': 'line_item',
+                'shipment_id': text(domestic_shipment.fba_shipment_id),
+                'sku': text(line_item.sku.sku),
+                'fnsku': text(line_item.sku.fnsku),
+                'units_per_case': number(packaging_profile.units_per_carton),
+                'cases': number(line_item.case_qty),
+                'units': number(line_item.ship_quantity),
+                'kg': line_item.kg,
+                'cbm': line_item.cbm,
+                'length_cm': number(packaging_profile.length_cm),
+                'width_cm': number(packaging_profile.width_cm),
+                'height_cm': number(packaging_profile.height_cm),
+                'carton_cbm': line_item.carton_cbm,
+                'weight_per_case_kg': number(packaging_profile.weight_kg),
+                'box_mark': text(line_item.box_mark)
+            }
+
+    for sku, sku_totals in summary['skus'].items():
+        yield {
+            'record_type': 'sku',
+            'sku': text(sku),
+            'cases': sku_totals['cases'],
+            'units': sku_totals['units']
+        }
+    yield {
+        'record_type': 'total',
+        'ship_to': text(shipment_group.cosignee),
+        'cases': summary['cases'],
+        'units': summary['units'],
+        'kg': summary['kg'],
+        'cbm': summary['cbm']
+    }
+
+
+def batches(rows, size=EXPORT_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_csv(rows, output):
+    columns = [name for name, kind in EXPORT_COLUMNS]
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for batch in batches(rows):
+        writer.writerows([row.get(name) for name in columns] for row in batch)
+        output.write(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+    output.write(buffer.getvalue().encode('utf-8'))
+
+
+def write_jsonl(rows, output):
+    columns = [name for name, kind in EXPORT_COLUMNS]
+    for batch in batches(rows):
+        output.write(''.join(
+            json.dumps({name: row.get(name) for name in columns}, ensure_ascii=False) + '\n' for row in batch
+        ).encode('utf-8'))
+
+
+PARQUET_UNAVAILABLE = 'Parquet export needs pyarrow, which is not installed'
+
+
+def check_export_format(output_format):
+    # fails for an export that can't be written here, so requests for it fail before anything is fetched
+    if output_format == 'parquet' and find_spec('pyarrow') is None:
+        raise ValueError(PARQUET_UNAVAILABLE)
+
+
+def write_parquet(rows, output):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(PARQUET_UNAVAILABLE)
+
+    schema = pyarrow.schema([
+        (name, pyarrow.string() if kind == 'string' else pyarrow.float64()) for name, kind in EXPORT_COLUMNS
+    ])
+    # every batch becomes its own row group, so only one batch is held in memory at a time
+    writer = pyarrow.parquet.ParquetWriter(output, schema, compression='snappy')
+    try:
+        for batch in batches(rows):
+            writer.write_table(pyarrow.Table.from_pylist(
+                [{name: row.get(name) for name, kind in EXPORT_COLUMNS} for row in batch],
+                schema=schema
+            ))
+    finally:
+        writer.close()
+
+
+EXPORT_WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'parquet': write_parquet
+}
+
+
+def write_export(shipment_group, domestic_shipments, summary, output_format, output):
+    EXPORT_WRITERS[output_format](export_rows(shipment_group, domestic_shipments, summary), output)
@@ -1,437 +1,1621 @@
+import base64
+import hashlib
+import hmac
 import json
-import xlsxwriter
 import os
-from airtable import Airtable
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from io import BytesIO
 from datetime import datetime
-import urllib
+from urllib.parse import unquote, urlparse
+from clients import aws_client
+from exports import EXPORT_FORMATS, check_export_format, write_export
+from jobs import finish_job, get_job_queue, get_job_store, job_progress, submit_job
+from leases import BatchLeases, get_lease_store, single_flight
+from metrics import metrics
+from models import DomesticShipment, FulfillmentCenter, LineItem, PackagingProfile, ShipmentGroup, Sku, field
 
-def read_field(obj, *fields):
-    try:
-        for field in fields:
-            if isinstance(obj[field], list):
-                obj = obj[field][0]
+# xlsxwriter, airtable (and with it requests), boto3 and multiprocessing are imported where they are
+# first used, so a cold start only loads what the request needs. PREWARM=true loads them and sets up
+# the clients during the Lambda init phase instead, see prewarm().
+
+# Airtable caps the URL length of list requests, so RECORD_ID() lookups are
+# split into chunks that keep the filterByFormula parameter well under it.
+# A chunk also fits into a single page, so every chunk is exactly one request.
+RECORD_ID_CHUNK_SIZE = 50
+
+# Airtable allows 5 requests per second per base and answers 429 above that
+AIRTABLE_REQUESTS_PER_SECOND = 5
+AIRTABLE_MAX_WORKERS = 10
+AIRTABLE_MAX_RETRIES = 5
+AIRTABLE_RETRY_BACKOFF = 1.0
+
+class RateLimiter(object):
+    """Sliding window shared by all threads talking to the same Airtable base: at most rate requests in
+    any period. A request holds its slot from acquire until period after its release, when it has
+    certainly reached Airtable, so the window Airtable counts in never holds more than rate of them."""
+
+    def __init__(self, rate, period=1.0):
+        self.rate = int(rate)
+        self.period = period
+        self.running = 0
+        self.released = deque()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.released and self.released[0] <= now - self.period:
+                    self.released.popleft()
+                if self.running + len(self.released) < self.rate:
+                    self.running += 1
+                    return
+                # with every slot taken by a running request, the next one frees up period after a release
+                self.condition.wait(self.released[0] + self.period - now if self.released else None)
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.released.append(time.monotonic())
+            self.condition.notify()
+
+airtable_rate_limiter = RateLimiter(AIRTABLE_REQUESTS_PER_SECOND)
+
+def airtable_request(func, *args, **kwargs):
+    # run a single Airtable API call under the rate limiter, retrying 429s with exponential backoff
+    from requests.exceptions import HTTPError
+
+    for attempt in range(AIRTABLE_MAX_RETRIES + 1):
+        throttle_start = time.monotonic()
+        airtable_rate_limiter.acquire()
+        metrics.increment('airtable_throttle_ms', (time.monotonic() - throttle_start) * 1000)
+        try:
+            return func(*args, **kwargs)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 429 or attempt == AIRTABLE_MAX_RETRIES:
+                raise
+            retry_after = e.response.headers.get('Retry-After')
+            delay = float(retry_after) if retry_after else AIRTABLE_RETRY_BACKOFF * 2 ** attempt
+        finally:
+            airtable_rate_limiter.release()
+        print('Airtable rate limit hit, retrying in {:.2f}s'.format(delay))
+        metrics.increment('airtable_retries')
+        time.sleep(delay + random.uniform(0, AIRTABLE_RETRY_BACKOFF))
+
+def airtable_get_all(table, **options):
+    # table.get_all with every page requested under the rate limiter. A throttled page is retried from its
+    # own offset, get_iter can't resume once a page raised.
+    records = []
+    offset = None
+    while True:
+        page = airtable_request(table._get, table.url_table, offset=offset, **options)
+        records.extend(page.get('records', []))
+        offset = page.get('offset')
+        if not offset:
+            return records
+
+def record_airtable_response(response, **kwargs):
+    # the table name is the last part of the table url, /v0/<base>/<table>[/<record id>]
+    table_name = unquote(urlparse(response.url).path.split('/')[3])
+    metrics.increment('airtable_requests')
+    metrics.increment('airtable_bytes', len(response.content))
+    metrics.observe('airtable_latency_ms.' + table_name, response.elapsed.total_seconds() * 1000)
+
+# Airtable tables and their HTTP session are created once per container. All tables of a key share one
+# session, so warm invocations reuse its pooled keep-alive connections to the API.
+airtable_sessions = {}
+airtable_tables = {}
+airtable_clients_lock = threading.Lock()
+
+def airtable_session(secret_key):
+    session = airtable_sessions.get(secret_key)
+    if session is None:
+        import requests
+        from airtable.auth import AirtableAuth
+
+        session = requests.Session()
+        session.auth = AirtableAuth(api_key=secret_key)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=AIRTABLE_MAX_WORKERS)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(record_airtable_response)
+        airtable_sessions[secret_key] = session
+    return session
+
+def airtable_table(app_id, table_name, secret_key):
+    key = (app_id, table_name, secret_key)
+    table = airtable_tables.get(key)
+    if table is None:
+        with airtable_clients_lock:
+            table = airtable_tables.get(key)
+            if table is None:
+                from airtable import Airtable
+
+                table = Airtable(app_id, table_name, secret_key)
+                # pacing is done by airtable_rate_limiter, not by sleeping after every page
+                table.API_LIMIT = 0
+                table.session = airtable_session(secret_key)
+                airtable_tables[key] = table
+    return table
+
+# SKUS, PackagingProfile and FCList rarely change, so their records are kept
+# in a module level cache that survives warm Lambda invocations.
+REFERENCE_TABLES = ('SKUS', 'PackagingProfile', 'FCList')
+REFERENCE_CACHE_TTL = float(os.getenv('REFERENCE_CACHE_TTL', 15 * 60))
+REFERENCE_CACHE_SIZE = int(os.getenv('REFERENCE_CACHE_SIZE', 10000))
+REFERENCE_CACHE_PATH = os.getenv('REFERENCE_CACHE_PATH')
+
+class ReferenceCache(object):
+    """TTL and size bounded LRU cache of Airtable records, optionally persisted to a JSON file."""
+
+    def __init__(self, ttl, max_size, path=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def key(self, table_name, record_id):
+        return '{}/{}'.format(table_name, record_id)
+
+    def load(self):
+        # read entries persisted by an earlier container, ignoring a missing or corrupt file
+        self.loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except Exception as e:
+            print('Error loading reference cache: ' + str(e))
+            return
+        now = time.time()
+        for key, (expires_at, record) in entries.items():
+            if expires_at > now:
+                self.entries[key] = (expires_at, record)
+        self.evict()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        try:
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print('Error saving reference cache: ' + str(e))
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_many(self, table_name, record_ids, fetched=None):
+        # the cached records by id. When given, the list fetched gets the time the oldest of them was
+        # fetched from Airtable appended.
+        records = {}
+        oldest = None
+        now = time.time()
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            for record_id in record_ids:
+                key = self.key(table_name, record_id)
+                entry = self.entries.get(key)
+                if entry and entry[0] > now:
+                    self.entries.move_to_end(key)
+                    records[record_id] = entry[1]
+                    oldest = entry[0] - self.ttl if oldest is None else min(oldest, entry[0] - self.ttl)
+                    self.hits += 1
+                else:
+                    if entry:
+                        del self.entries[key]
+                    self.misses += 1
+        if fetched is not None and oldest is not None:
+            fetched.append(oldest)
+        return records
+
+    def put_many(self, table_name, records):
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            for record in records:
+                key = self.key(table_name, record['id'])
+                self.entries[key] = (expires_at, record)
+                self.entries.move_to_end(key)
+            self.evict()
+
+    def invalidate(self, table_name=None, record_ids=None):
+        # drop everything, a whole table, or single records of a table
+        with self.lock:
+            if table_name is None:
+                self.entries.clear()
+            elif record_ids is None:
+                prefix = self.key(table_name, '')
+                for key in [key for key in self.entries if key.startswith(prefix)]:
+                    del self.entries[key]
             else:
-                obj = obj[field]
-        return obj
-    except:
-        return ''
+                for record_id in record_ids:
+                    self.entries.pop(self.key(table_name, record_id), None)
+        self.save()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+reference_cache = ReferenceCache(REFERENCE_CACHE_TTL, REFERENCE_CACHE_SIZE, REFERENCE_CACHE_PATH)
 
-def get_domestic_shipments_from_airtable(app_id, secret_key, shipment_group_id):
+# Only the fields the packing list is built from are requested, which keeps long texts, attachments
+# and lookups nobody reads out of the responses
+AIRTABLE_FIELDS = {
+    'ShipmentGroup': ['DomesticShipments', 'Cosignee Name', 'PackingLists Generated'],
+    'Domestic Shipments': ['FCID', 'LineItems', 'FBA Shipment ID', 'AMZReferenceID'],
+    'DomesticShipmentLineItem': ['SKU', 'PackagingProfile', 'CaseQty', 'ShipQuantity', 'BoxMark'],
+    'SKUS': ['SKU', 'FNSKU'],
+    'PackagingProfile': ['UnitsPerCarton', 'CartonLengthCM', 'CartonWidthCM', 'CartonHeightCM', 'CartonWeightKG'],
+    'FCList': ['FCID', 'FCAddress', 'FacilityCountry']
+}
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def record_id_formula(record_ids):
+    return 'OR({})'.format(','.join("RECORD_ID()='{}'".format(record_id) for record_id in record_ids))
+
+def cached_records(table, record_ids, fetched=None):
+    # the records of reference tables that reference_cache holds, an empty dict for other tables.
+    # fetched collects when the oldest of them was fetched, see ReferenceCache.get_many.
+    if table.table_name not in REFERENCE_TABLES:
+        return {}
+    records = reference_cache.get_many(table.table_name, record_ids, fetched)
+    metrics.increment('reference_cache_hits', len(records))
+    metrics.increment('reference_cache_misses', len(record_ids) - len(records))
+    return records
+
+def request_records(executor, table, record_ids):
+    # start fetching records by id, returns the futures of the RECORD_ID() chunk requests
+    return [
+        executor.submit(airtable_get_all, table, formula=record_id_formula(chunk), fields=AIRTABLE_FIELDS[table.table_name])
+        for chunk in chunks(record_ids, RECORD_ID_CHUNK_SIZE)
+    ]
+
+def request_records_by_ids(executor, table, record_ids, fetched=None):
+    # start fetching the records of table with the given ids. Reference tables are served from
+    # reference_cache and only the misses are requested. Returns the unique record ids, the records
+    # found so far and the futures of the requests.
+    record_ids = list(dict.fromkeys(record_ids))
+    records = cached_records(table, record_ids, fetched)
+    futures = request_records(executor, table, [record_id for record_id in record_ids if record_id not in records])
+    return record_ids, records, futures
+
+def receive_records_by_ids(table, record_ids, records, futures, strict=True):
+    # wait for the requests of request_records_by_ids and return all records keyed by record id.
+    # Fetched reference records are added to reference_cache, which the caller saves.
+    # Records that don't exist raise a ValueError, or are left out when strict is False.
+    fetched = [record for future in futures for record in future.result()]
+    for record in fetched:
+        records[record['id']] = record
+    if fetched and table.table_name in REFERENCE_TABLES:
+        reference_cache.put_many(table.table_name, fetched)
+    missing = [record_id for record_id in record_ids if record_id not in records]
+    if missing and strict:
+        raise ValueError('Records not found in {}: {}'.format(table.table_name, ', '.join(missing)))
+    return records
+
+def get_records_by_ids(executor, *lookups, strict=True, fetched=None):
+    # fetch the records of every (table, record_ids) lookup concurrently, keyed by record id per lookup
+    pending = [(table,) + request_records_by_ids(executor, table, record_ids, fetched) for table, record_ids in lookups]
+    results = [receive_records_by_ids(*lookup, strict=strict) for lookup in pending]
+    if any(table.table_name in REFERENCE_TABLES and futures for table, record_ids, records, futures in pending):
+        reference_cache.save()
+    return results
+
+def find_record(records, table_name, record_id):
     try:
-        # initialize airtable tables
-        tbl_domestic_shipments = Airtable(app_id, 'Domestic Shipments', secret_key)
-        tbl_fclist = Airtable(app_id, 'FCList', secret_key)
-        tbl_domestic_shipment_line_item = Airtable(app_id, 'DomesticShipmentLineItem', secret_key)
-        tbl_skus = Airtable(app_id, 'SKUS', secret_key)
-        tbl_packaging_profile = Airtable(app_id, 'PackagingProfile', secret_key)
-        tbl_shipment_group = Airtable(app_id, 'ShipmentGroup', secret_key)
+        return records[table_name][record_id]
+    except KeyError:
+        raise ValueError('Record not found in {}: {}'.format(table_name, record_id))
+
+def resolve_reference(records, resolved, model, table_name, record_id):
+    # reference records are converted once and shared by every line item and shipment group linking them
+    key = (table_name, record_id)
+    if key not in resolved:
+        resolved[key] = model.from_record(find_record(records, table_name, record_id))
+    return resolved[key]
+
+def resolve_domestic_shipment(records, domestic_shipment_id, resolved):
+    domestic_shipment = find_record(records, 'Domestic Shipments', domestic_shipment_id)
+
+    # get shipment information
+    fulfillment_center = None
+    if 'FCID' in domestic_shipment['fields']:
+        fulfillment_center = resolve_reference(records, resolved, FulfillmentCenter, 'FCList', domestic_shipment['fields']['FCID'][0])
+
+    # get line items
+    line_items = []
+    for domestic_shipment_line_item in domestic_shipment['fields']['LineItems']:
+        line_item = find_record(records, 'DomesticShipmentLineItem', domestic_shipment_line_item)
+        line_items.append(LineItem.from_record(
+            line_item,
+            resolve_reference(records, resolved, Sku, 'SKUS', line_item['fields']['SKU'][0]),
+            resolve_reference(records, resolved, PackagingProfile, 'PackagingProfile', line_item['fields']['PackagingProfile'][0])
+        ))
+
+    return DomesticShipment.from_record(domestic_shipment, fulfillment_center, line_items)
+
+def resolve_shipment_group(records, shipment_group_id, resolved=None):
+    # normalize the fetched records of one shipment group into a ShipmentGroup, resolved holds the
+    # reference models already converted for other groups
+    resolved = {} if resolved is None else resolved
+    shipment_group = find_record(records, 'ShipmentGroup', shipment_group_id)
+    domestic_shipments = [
+        resolve_domestic_shipment(records, domestic_shipment_id, resolved)
+        for domestic_shipment_id in shipment_group['fields']['DomesticShipments']
+    ]
+    return ShipmentGroup.from_record(shipment_group, domestic_shipments)
+
+def get_shipment_groups_from_airtable(app_id, secret_key, shipment_group_ids):
+    # fetch the union of all records referenced by the shipment groups level by level, so records shared
+    # between groups are requested only once. Returns the ShipmentGroup of every group that could be
+    # resolved and the error message of every group that could not.
+    tbl_domestic_shipments = airtable_table(app_id, 'Domestic Shipments', secret_key)
+    tbl_fclist = airtable_table(app_id, 'FCList', secret_key)
+    tbl_domestic_shipment_line_item = airtable_table(app_id, 'DomesticShipmentLineItem', secret_key)
+    tbl_skus = airtable_table(app_id, 'SKUS', secret_key)
+    tbl_packaging_profile = airtable_table(app_id, 'PackagingProfile', secret_key)
+    tbl_shipment_group = airtable_table(app_id, 'ShipmentGroup', secret_key)
+
+    print('##### Getting data from Airtable started #####')
+
+    # fetch times of the oldest reference records served from reference_cache
+    fetched = []
+    with ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS) as executor:
+        shipment_groups_by_id, = get_records_by_ids(executor, (tbl_shipment_group, shipment_group_ids), strict=False)
 
-        print('##### Getting data from Airtable started #####')
-        
-        shipment_group = tbl_shipment_group.get(shipment_group_id)
-        
         # get all domestic shipments
-        domestic_shipments = []
-        
-        for domestic_shipment_id in shipment_group['fields']['DomesticShipments']:
-            domestic_shipment = tbl_domestic_shipments.get(domestic_shipment_id)
-            
-            if 'Cosignee Name' in shipment_group['fields']:
-                domestic_shipment['cosignee'] = shipment_group['fields']['Cosignee Name']
-            
-            # get shipment information
-            if 'FCID' in domestic_shipment['fields']:
-                domestic_shipment['shipment'] = tbl_fclist.get(domestic_shipment['fields']['FCID'][0])
-            
-            # get line items
-            line_items = []
-            for domestic_shipment_line_item in domestic_shipment['fields']['LineItems']:
-                line_item = tbl_domestic_shipment_line_item.get(domestic_shipment_line_item)
-                line_item['sku'] = tbl_skus.get(line_item['fields']['SKU'][0])
-                line_item['packaging_profile'] = tbl_packaging_profile.get(line_item['fields']['PackagingProfile'][0])
-                line_items.append(line_item)
-            domestic_shipment['line_items'] = line_items
-
-            domestic_shipments.append(domestic_shipment)
-        print('##### Getting data from Airtable finished #####')
-        return domestic_shipments
+        domestic_shipment_ids = [
+            domestic_shipment_id
+            for shipment_group in shipment_groups_by_id.values()
+            for domestic_shipment_id in shipment_group['fields'].get('DomesticShipments', [])
+        ]
+        domestic_shipments_by_id, = get_records_by_ids(executor, (tbl_domestic_shipments, domestic_shipment_ids), strict=False)
+
+        # get shipment information and line items of all domestic shipments at once
+        domestic_shipments = domestic_shipments_by_id.values()
+        fc_ids = [domestic_shipment['fields']['FCID'][0] for domestic_shipment in domestic_shipments if 'FCID' in domestic_shipment['fields']]
+        line_item_ids = [line_item_id for domestic_shipment in domestic_shipments for line_item_id in domestic_shipment['fields'].get('LineItems', [])]
+        fcs_by_id, line_items_by_id = get_records_by_ids(
+            executor,
+            (tbl_fclist, fc_ids),
+            (tbl_domestic_shipment_line_item, line_item_ids),
+            strict=False,
+            fetched=fetched
+        )
+
+        # get skus and packaging profiles of all line items at once
+        line_items = line_items_by_id.values()
+        skus_by_id, packaging_profiles_by_id = get_records_by_ids(
+            executor,
+            (tbl_skus, [line_item['fields']['SKU'][0] for line_item in line_items if 'SKU' in line_item['fields']]),
+            (tbl_packaging_profile, [line_item['fields']['PackagingProfile'][0] for line_item in line_items if 'PackagingProfile' in line_item['fields']]),
+            strict=False,
+            fetched=fetched
+        )
+
+    records = {
+        'ShipmentGroup': shipment_groups_by_id,
+        'Domestic Shipments': domestic_shipments_by_id,
+        'FCList': fcs_by_id,
+        'DomesticShipmentLineItem': line_items_by_id,
+        'SKUS': skus_by_id,
+        'PackagingProfile': packaging_profiles_by_id
+    }
+    shipment_groups = OrderedDict()
+    errors = OrderedDict()
+    resolved = {}
+    for shipment_group_id in shipment_group_ids:
+        try:
+            shipment_groups[shipment_group_id] = resolve_shipment_group(records, shipment_group_id, resolved)
+            # the cache hits aren't tracked per group, so every group counts from the oldest of them
+            shipment_groups[shipment_group_id].fetched = min(fetched) if fetched else None
+        except Exception as e:
+            errors[shipment_group_id] = str(e)
+
+    print('##### Reference cache: {hits} hits, {misses} misses, {size} records #####'.format(**reference_cache.stats()))
+    print('##### Getting data from Airtable finished #####')
+    return shipment_groups, errors
+
+def airtable_fetch_error(e):
+    print('Error getting domestic shipments from Airtable: ' + str(e))
+    return ValueError('Error getting domestic shipments from Airtable: ' + str(e))
+
+# line item chunks requested ahead of the domestic shipment being resolved
+STREAM_PREFETCH_CHUNKS = AIRTABLE_MAX_WORKERS
+
+def stream_shipment_group_from_airtable(app_id, secret_key, shipment_group_id):
+    """Fetch one shipment group so it can be rendered while its domestic shipments are still loading.
+
+    Returns the ShipmentGroup, without domestic shipments yet, and a generator that fetches them and
+    yields every DomesticShipment in order as soon as its line items and the records they link are in.
+    Yielded shipments are appended to the group, which is complete once the generator is exhausted.
+    """
+    started = time.monotonic()
+    try:
+        tbl_shipment_group = airtable_table(app_id, 'ShipmentGroup', secret_key)
+        tbl_domestic_shipments = airtable_table(app_id, 'Domestic Shipments', secret_key)
+
+        print('##### Getting data from Airtable started #####')
+
+        with ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS) as executor:
+            records = {}
+            records['ShipmentGroup'], = get_records_by_ids(executor, (tbl_shipment_group, [shipment_group_id]), strict=False)
+            shipment_group = find_record(records, 'ShipmentGroup', shipment_group_id)
+            records['Domestic Shipments'], = get_records_by_ids(
+                executor,
+                (tbl_domestic_shipments, shipment_group['fields']['DomesticShipments']),
+                strict=False
+            )
+    except Exception as e:
+        raise airtable_fetch_error(e)
+
+    shipment_group = ShipmentGroup.from_record(shipment_group, [])
+    return shipment_group, fetch_domestic_shipments(app_id, secret_key, records, shipment_group, started)
+
+def fetch_domestic_shipments(app_id, secret_key, records, shipment_group, started):
+    # the generator of stream_shipment_group_from_airtable. Line items are requested in shipment order with
+    # STREAM_PREFETCH_CHUNKS chunks in flight, the SKUs and packaging profiles they link as soon as a full
+    # chunk of ids that aren't cached is known and the rest once all line items are in, so there are no
+    # more requests than when every table is fetched at once. The fetch timing covers the whole stream.
+    tables = {
+        table_name: airtable_table(app_id, table_name, secret_key)
+        for table_name in ('FCList', 'DomesticShipmentLineItem', 'SKUS', 'PackagingProfile')
+    }
+    domestic_shipment_ids = records['ShipmentGroup'][shipment_group.id]['fields']['DomesticShipments']
+    domestic_shipments = [
+        records['Domestic Shipments'][domestic_shipment_id]
+        for domestic_shipment_id in domestic_shipment_ids if domestic_shipment_id in records['Domestic Shipments']
+    ]
+    for table_name in tables:
+        records[table_name] = {}
+    # requests by table in the order they were made, as (table, record ids, records, futures)
+    pending = {table_name: deque() for table_name in tables}
+    requested = []
+    queued = {'SKUS': [], 'PackagingProfile': []}
+    seen = {'SKUS': set(), 'PackagingProfile': set()}
+    line_items_received = set()
+    # fetch times of the oldest reference records served from reference_cache
+    fetched = []
+    executor = ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS)
+
+    def request(table_name, record_ids, cached=None):
+        lookup = (tables[table_name], record_ids, cached or {}, request_records(executor, tables[table_name], record_ids))
+        pending[table_name].append(lookup)
+        requested.append(lookup)
+
+    def receive(table_name):
+        lookup = pending[table_name].popleft()
+        records[table_name].update(receive_records_by_ids(*lookup, strict=False))
+        return lookup
+
+    def receive_line_items():
+        table, line_item_ids, line_items, futures = receive('DomesticShipmentLineItem')
+        line_items_received.update(line_item_ids)
+        while line_item_chunks and len(pending['DomesticShipmentLineItem']) < STREAM_PREFETCH_CHUNKS:
+            request('DomesticShipmentLineItem', line_item_chunks.popleft())
+
+        for table_name, field_name in (('SKUS', 'SKU'), ('PackagingProfile', 'PackagingProfile')):
+            record_ids = []
+            for line_item_id in line_item_ids:
+                line_item = records['DomesticShipmentLineItem'].get(line_item_id)
+                if line_item and field_name in line_item['fields'] and line_item['fields'][field_name][0] not in seen[table_name]:
+                    seen[table_name].add(line_item['fields'][field_name][0])
+                    record_ids.append(line_item['fields'][field_name][0])
+            records[table_name].update(cached_records(tables[table_name], record_ids, fetched))
+            queued[table_name].extend(record_id for record_id in record_ids if record_id not in records[table_name])
+            while len(queued[table_name]) >= RECORD_ID_CHUNK_SIZE:
+                request(table_name, queued[table_name][:RECORD_ID_CHUNK_SIZE])
+                del queued[table_name][:RECORD_ID_CHUNK_SIZE]
+
+    def wait_for(table_name, record_id):
+        while record_id not in records[table_name]:
+            if pending[table_name]:
+                receive(table_name)
+            elif record_id in queued.get(table_name, ()):
+                if pending['DomesticShipmentLineItem']:
+                    receive_line_items()
+                else:
+                    request(table_name, queued[table_name])
+                    queued[table_name] = []
+            else:
+                # doesn't exist, resolving the shipment reports it
+                return
+
+    try:
+        fc_ids = list(dict.fromkeys(domestic_shipment['fields']['FCID'][0] for domestic_shipment in domestic_shipments if 'FCID' in domestic_shipment['fields']))
+        fcs = cached_records(tables['FCList'], fc_ids, fetched)
+        request('FCList', [fc_id for fc_id in fc_ids if fc_id not in fcs], fcs)
+
+        line_item_chunks = deque(chunks(list(dict.fromkeys(
+            line_item_id for domestic_shipment in domestic_shipments for line_item_id in domestic_shipment['fields'].get('LineItems', [])
+        )), RECORD_ID_CHUNK_SIZE))
+        while line_item_chunks and len(pending['DomesticShipmentLineItem']) < STREAM_PREFETCH_CHUNKS:
+            request('DomesticShipmentLineItem', line_item_chunks.popleft())
+
+        resolved = {}
+        for domestic_shipment_id in domestic_shipment_ids:
+            domestic_shipment = records['Domestic Shipments'].get(domestic_shipment_id)
+            if domestic_shipment:
+                for line_item_id in domestic_shipment['fields'].get('LineItems', []):
+                    while line_item_id not in line_items_received and pending['DomesticShipmentLineItem']:
+                        receive_line_items()
+                    line_item = records['DomesticShipmentLineItem'].get(line_item_id)
+                    if line_item:
+                        for table_name, field_name in (('SKUS', 'SKU'), ('PackagingProfile', 'PackagingProfile')):
+                            if field_name in line_item['fields']:
+                                wait_for(table_name, line_item['fields'][field_name][0])
+                if 'FCID' in domestic_shipment['fields']:
+                    wait_for('FCList', domestic_shipment['fields']['FCID'][0])
+
+            domestic_shipment = resolve_domestic_shipment(records, domestic_shipment_id, resolved)
+            shipment_group.domestic_shipments.append(domestic_shipment)
+            shipment_group.fetched = min(fetched) if fetched else None
+            yield domestic_shipment
+
+        if any(table.table_name in REFERENCE_TABLES and futures for table, record_ids, cached, futures in requested):
+            reference_cache.save()
     except Exception as e:
-        print('Error getting domestic shipments from Airtable: ' + str(e))
-        raise ValueError('Error getting domestic shipments from Airtable: ' + str(e))
+        raise airtable_fetch_error(e)
+    finally:
+        # a consumer that stops early leaves requests nobody needs anymore
+        for table, record_ids, cached, futures in requested:
+            for future in futures:
+                future.cancel()
+        executor.shutdown()
+
+    metrics.add_timing('fetch', (time.monotonic() - started) * 1000)
+    print('##### Reference cache: {hits} hits, {misses} misses, {size} records #####'.format(**reference_cache.stats()))
+    print('##### Getting data from Airtable finished #####')
 
 
-def upload_packaging_list_to_airtable(app_id, secret_key, record_id, list_url):
+# Airtable creates and updates at most 10 records per request
+AIRTABLE_BATCH_SIZE = 10
+
+def packing_lists_update(shipment_group, list_url):
+    # PackingLists Generated with list_url appended, based on the state fetched with the shipment group.
+    # Attachments already on the record are referenced by id only, Airtable keeps them as they are.
+    packing_lists = [{'id': attachment['id']} if 'id' in attachment else attachment for attachment in shipment_group.packing_lists]
+    packing_lists.append({'url': list_url})
+    return {'PackingLists Generated': packing_lists}
+
+def upload_packaging_list_to_airtable(app_id, secret_key, shipment_group, list_url):
     try:
-        # initialize airtable tables
         print('##### Uploading packaging list to Airtable started #####')
-        tbl_shipment_group = Airtable(app_id, 'ShipmentGroup', secret_key)
-        shipment_group_record = tbl_shipment_group.get(record_id)
-        packing_lists = []
-        if 'PackingLists Generated' in shipment_group_record['fields']:
-            packing_lists = shipment_group_record['fields']['PackingLists Generated']
-        packing_lists.append({'url': list_url})
-        tbl_shipment_group.update(shipment_group_record['id'], {
-            'PackingLists Generated': packing_lists
-        })
+        tbl_shipment_group = airtable_table(app_id, 'ShipmentGroup', secret_key)
+        airtable_request(tbl_shipment_group.update, shipment_group.id, packing_lists_update(shipment_group, list_url))
         print('##### Uploading packaging list to Airtable finished #####')
     except Exception as e:
         print('Error uploading packaging list to Airtable: ' + str(e))
         raise ValueError('Error uploading packaging list to Airtable: ' + str(e))
 
+
+class AirtableUpdateQueue(object):
+    """Collects record updates for one table and sends them as batch updates of AIRTABLE_BATCH_SIZE records.
+
+    A full batch is sent as soon as it is queued, flush() sends the rest and returns the error message
+    of every record whose update failed.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = OrderedDict()
+        self.errors = OrderedDict()
+
+    def add(self, record_id, fields):
+        self.pending.setdefault(record_id, {}).update(fields)
+        if len(self.pending) >= AIRTABLE_BATCH_SIZE:
+            self.send()
+
+    def send(self):
+        records = [{'id': record_id, 'fields': fields} for record_id, fields in self.pending.items()]
+        self.pending = OrderedDict()
+        for batch in chunks(records, AIRTABLE_BATCH_SIZE):
+            try:
+                with metrics.timer('attach'):
+                    airtable_request(self.table._patch, self.table.url_table, {'records': batch})
+            except Exception as e:
+                print('Error updating records in Airtable: ' + str(e))
+                for record in batch:
+                    self.errors[record['id']] = str(e)
+
+    def flush(self):
+        if self.pending:
+            self.send()
+        return self.errors
+
 def get_skus(domestic_shipments):
-    skus = []
+    # unique skus in order of first appearance
+    skus = {}
+    for domestic_shipment in domestic_shipments:
+        for line_item in domestic_shipment.line_items:
+            skus[line_item.sku.sku] = True
+    return list(skus)
+
+
+def to_number(value):
+    # blank or non-numeric cells count as 0 in the packing list formulas
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def packing_list_summary():
+    return {
+        'skus': OrderedDict(),
+        'kg': 0,
+        'cbm': 0,
+        'cases': 0,
+        'units': 0
+    }
+
+
+def aggregate_domestic_shipment(domestic_shipment, summary):
+    # compute every value the packing list formulas of one shipment evaluate to, so they can be written
+    # as cached results, and add them to summary
+    totals = {
+        'kg': 0,
+        'cbm': 0,
+        'cases': 0,
+        'units': 0
+    }
+    for line_item in domestic_shipment.line_items:
+        packaging_profile = line_item.packaging_profile
+        cases = to_number(line_item.case_qty)
+        units = to_number(line_item.ship_quantity)
+        line_item.carton_cbm = to_number(packaging_profile.length_cm) * \
+            to_number(packaging_profile.width_cm) * \
+            to_number(packaging_profile.height_cm) / 1000000
+        line_item.kg = to_number(packaging_profile.weight_kg) * cases
+        line_item.cbm = line_item.carton_cbm * cases
+
+        totals['kg'] += line_item.kg
+        totals['cbm'] += line_item.cbm
+        totals['cases'] += cases
+        totals['units'] += units
+
+        sku = summary['skus'].setdefault(line_item.sku.sku, {'units': 0, 'cases': 0})
+        sku['units'] += units
+        sku['cases'] += cases
+
+    domestic_shipment.totals = totals
+    for key in totals:
+        summary[key] += totals[key]
+
+
+def aggregate_packing_list(domestic_shipments):
+    summary = packing_list_summary()
+    for domestic_shipment in domestic_shipments:
+        aggregate_domestic_shipment(domestic_shipment, summary)
+    return summary
+
+
+def aggregate_while_iterating(domestic_shipments, summary):
+    # yields the domestic shipments, each aggregated into summary first
+    for domestic_shipment in domestic_shipments:
+        aggregate_domestic_shipment(domestic_shipment, summary)
+        yield domestic_shipment
+
+
+def plan_packing_list_layout(domestic_shipments):
+    # first pass: work out the rows of every domestic shipment block from the data alone,
+    # so the worksheet can be written strictly top to bottom afterwards
+    skus = get_skus(domestic_shipments)
+    domestic_shipment_line = 7 + len(skus)
     for domestic_shipment in domestic_shipments:
-        for line_item in domestic_shipment['line_items']:
-            sku = line_item['sku']['fields']['SKU']
-            if not sku in skus:
-                skus.append(sku)
+        domestic_shipment_line_start = domestic_shipment_line + 10
+        domestic_shipment_line_end = domestic_shipment_line_start + len(domestic_shipment.line_items)
+
+        domestic_shipment.domestic_shipment_line = domestic_shipment_line
+        domestic_shipment.total_line = domestic_shipment_line + 3
+        domestic_shipment.domestic_shipment_line_start = domestic_shipment_line_start
+        domestic_shipment.domestic_shipment_line_end = domestic_shipment_line_end
+        domestic_shipment_line = domestic_shipment_line_end + 6
     return skus
 
 
-def generate_excel_file(domestic_shipments, file_name=None):
-    try: 
-        # Create an new Excel file and add a worksheet.
-        print('##### Generating packaging list started #####')
-        output = BytesIO()
-        if file_name:
-            workbook = xlsxwriter.Workbook(file_name)
-        else:
-            workbook = xlsxwriter.Workbook(output)
-        
-        worksheet = workbook.add_worksheet()
-
-        # apply styles
-        worksheet.set_column('A:A', 15)
-        worksheet.set_column('B:B', 15)
-        worksheet.set_column('C:C', 13)
-        worksheet.set_column('D:D', 13)
-        worksheet.set_column('E:E', 15)
-        worksheet.set_column('F:F', 13)
-        worksheet.set_column('G:G', 15)
-        worksheet.set_column('L:L', 14)
-        worksheet.set_column('M:M', 20)
-        worksheet.set_row(0, 20)
-        worksheet.set_row(2, 50)
-
-        # formats
-        highlight_format = workbook.add_format({
+def add_packing_list_formats(workbook):
+    return {
+        'title': workbook.add_format({
+            'bold': 1,
+            'align': 'center',
+            'valign': 'vcenter',
+            'font_size': 14
+        }),
+        'subtitle': workbook.add_format({
+            'bold': 1,
+            'align': 'center',
+            'valign': 'vcenter'
+        }),
+        'highlight': workbook.add_format({
             'fg_color': 'yellow'
-        })
-        rect_format = workbook.add_format({
+        }),
+        'rect': workbook.add_format({
             'border': 1,
             'align': 'center'
-        })
-        table_header_format = workbook.add_format({
+        }),
+        'table_header': workbook.add_format({
             'fg_color': '#FCE4D6',
             'border': 1,
             'valign': 'bottom',
             'text_wrap': True
-        })
-        table_header_without_border_format = workbook.add_format({
+        }),
+        'table_header_without_border': workbook.add_format({
             'fg_color': '#FCE4D6',
             'valign': 'bottom'
-        })
-        box_header_format = workbook.add_format({
+        }),
+        'box_header': workbook.add_format({
             'fg_color': 'red',
             'border': 1,
             'valign': 'bottom'
-        })
-        rect_box_format = workbook.add_format({
+        }),
+        'rect_box': workbook.add_format({
             'fg_color': 'red',
             'border': 1,
             'align': 'center'
-        })
-        number_format = workbook.add_format({
+        }),
+        'number': workbook.add_format({
             'num_format': '0.00'
-        })
-        rect_number_format = workbook.add_format({
+        }),
+        'rect_number': workbook.add_format({
             'num_format': '0.00',
             'border': 1,
             'align': 'center'
-        })
-        rect_integer_format = workbook.add_format({
+        }),
+        'rect_integer': workbook.add_format({
             'num_format': '0',
             'border': 1,
             'align': 'center'
-        })
-        highlight_number_format = workbook.add_format({
-            'fg_color': 'yellow',
-            'num_format': '0.00'
-        })
-        text_wrap_format = workbook.add_format({
+        }),
+        'text_wrap': workbook.add_format({
             'text_wrap': True
-        })
-        border_top_format = workbook.add_format({
+        }),
+        'border_top': workbook.add_format({
             'top': 1
-        })
-        border_thick_top_format = workbook.add_format({
+        }),
+        'border_thick_top': workbook.add_format({
             'top': 2
-        })
-        integer_format = workbook.add_format({
+        }),
+        'integer': workbook.add_format({
             'num_format': '0'
-        })
-        
-        # fill in basic information
-        worksheet.merge_range('A1:M1', 'Packing List', workbook.add_format({
-            'bold': 1,
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_size': 14
-        }))
-        worksheet.merge_range('A2:C2', 'Shipment Summary', workbook.add_format({
-            'bold': 1,
-            'align': 'center',
-            'valign': 'vcenter'
-        }))
-
-        worksheet.write('B3', 'Units Shipped 订货数量（套）', text_wrap_format)
-        worksheet.write('C3', 'Number of Cases/箱数量', text_wrap_format)
-
-        worksheet.write('I4', 'Ship To', workbook.add_format({
+        }),
+        'sku_total': workbook.add_format({
+            'top': 1,
+            'num_format': '0'
+        }),
+        'ship_to_label': workbook.add_format({
             'fg_color': 'yellow',
             'bold': 1,
             'left': 2,
             'top': 2,
             'bottom': 2
-        }))
-        worksheet.write('J4', read_field(domestic_shipments[0], 'cosignee'), workbook.add_format({
-            'fg_color': 'yellow',
-            'top': 2,
-            'bottom': 2
-        }))
-        workbook.define_name('VBA_ShipTo', '=Sheet1!$J$4')
-        worksheet.write('K4', '', workbook.add_format({
+        }),
+        'ship_to': workbook.add_format({
             'fg_color': 'yellow',
             'top': 2,
             'bottom': 2
-        }))
-        worksheet.write('L4', '', workbook.add_format({
+        }),
+        'ship_to_end': workbook.add_format({
             'fg_color': 'yellow',
             'right': 2,
             'top': 2,
             'bottom': 2
-        }))
-
-        skus = get_skus(domestic_shipments)
-        domestic_shipment_line = 7 + len(skus)
-        # loop through all domestic shipments
-        for domestic_shipment in domestic_shipments:
-            # draw top thick border
-            for i in range(12):
-                worksheet.write(domestic_shipment_line - 1, i, '', border_thick_top_format)
-
-            # fill in shipment information
-            shipment = read_field(domestic_shipment, 'shipment')
-            domestic_shipment_line_start = domestic_shipment_line + 10
-            domestic_shipment_line_end = domestic_shipment_line_start + len(domestic_shipment['line_items'])
-
-            # Fulfillment Center
-            worksheet.write(domestic_shipment_line, 0, 'Fulfillment Center')
-            worksheet.write(domestic_shipment_line, 1, read_field(shipment, 'fields', 'FCID'), highlight_format)
-            worksheet.write(domestic_shipment_line, 2, '', highlight_format)
-
-            # Shipment ID
-            worksheet.write(domestic_shipment_line + 1, 0, 'Shipment ID')
-            worksheet.write(domestic_shipment_line + 1, 1, read_field(domestic_shipment, 'fields', 'FBA Shipment ID'), highlight_format)
-            worksheet.write(domestic_shipment_line + 1, 2, '', highlight_format)
-
-            # Reference ID
-            worksheet.write(domestic_shipment_line + 2, 0, 'Reference ID')
-            worksheet.write(domestic_shipment_line + 2, 1, read_field(domestic_shipment, 'fields', 'AMZReferenceID'), highlight_format)
-            worksheet.write(domestic_shipment_line + 2, 2, '', highlight_format)
-
-            # Ship To
-            worksheet.write(domestic_shipment_line + 3, 0, 'Ship to')
-            worksheet.write_formula(domestic_shipment_line + 3, 1, '=VBA_ShipTo', highlight_format)
-            worksheet.write(domestic_shipment_line + 3, 2, '', highlight_format)
-
-            # Total KG
-            worksheet.write(domestic_shipment_line + 3, 5, 'Total KG 总公斤')
-            worksheet.write_formula(domestic_shipment_line + 3, 8, '=SUM($F${}:$F${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), number_format)
-            
-            # Total CBM
-            worksheet.write(domestic_shipment_line + 4, 5, 'Total CBM 总立方米')
-            worksheet.write_formula(domestic_shipment_line + 4, 8, '=SUM($G${}:$G${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), number_format)
-
-            # Number of Cases
-            worksheet.write(domestic_shipment_line + 5, 5, 'Number of Cases/箱数量')
-            worksheet.write_formula(domestic_shipment_line + 5, 8, '=SUM($D${}:$D${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), integer_format)
-
-            # Units Shipped
-            worksheet.write(domestic_shipment_line + 6, 5, 'Units Shipped 订货数量（套）')
-            worksheet.write_formula(domestic_shipment_line + 6, 8, '=SUM($E${}:$E${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), integer_format)
-
-            # Cosignee
-            worksheet.write(domestic_shipment_line + 4, 0, 'Cosignee')
-            worksheet.write(domestic_shipment_line + 4, 1, read_field(domestic_shipment, 'cosignee'), highlight_format)
-            worksheet.write(domestic_shipment_line + 4, 2, '', highlight_format)
-            address = read_field(shipment, 'fields', 'FCAddress').split(', ', 1)
-            worksheet.write(domestic_shipment_line + 5, 1, address[0], highlight_format)
-            worksheet.write(domestic_shipment_line + 5, 2, '', highlight_format)
-            try:
-                worksheet.write(domestic_shipment_line + 6, 1, address[1], highlight_format)
-            except:
-                worksheet.write(domestic_shipment_line + 6, 1, '', highlight_format)
-            worksheet.write(domestic_shipment_line + 6, 2, '', highlight_format)
-            worksheet.write(domestic_shipment_line + 7, 1, read_field(shipment, 'fields', 'FacilityCountry'), highlight_format)
-            worksheet.write(domestic_shipment_line + 7, 2, '', highlight_format)
-            
-            # fill in line items
-            # title
-            for i in range(12):
-                worksheet.write(domestic_shipment_line + 8, i, '箱子规格 / case dimensions' if i == 7 else '', table_header_without_border_format)
-            
-            # headers
-            worksheet.set_row(domestic_shipment_line + 9, 50)
-            worksheet.write(domestic_shipment_line + 9, 0, 'SKU', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 1, 'FNSKU 条形码编号', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 2, 'Units per Case /外箱包装', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 3, 'Number of Cases/箱数量', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 4, 'Units Shipped 订货数量（套）', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 5, 'Total KG 总公斤', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 6, 'Total CBM 总立方米', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 7, '长 length', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 8, '宽 width', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 9, '高 height', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 10, '总CBM', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 11, 'Weight Per Case 外箱重量', table_header_format)
-            worksheet.write(domestic_shipment_line + 9, 12, 'Box Mark分箱号：', box_header_format)
-
-            # line item values
-            for index, line_item in enumerate(domestic_shipment['line_items']):
-                sku = read_field(line_item, 'sku')
-                packaging_profile = read_field(line_item, 'packaging_profile')
-
-                worksheet.write(domestic_shipment_line_start + index, 0, read_field(sku, 'fields', 'SKU'), rect_format)
-                worksheet.write(domestic_shipment_line_start + index, 1, read_field(sku ,'fields', 'FNSKU'), rect_format)
-                worksheet.write(domestic_shipment_line_start + index, 2, read_field(packaging_profile, 'fields', 'UnitsPerCarton'), rect_integer_format)
-                worksheet.write(domestic_shipment_line_start + index, 3, read_field(line_item, 'fields', 'CaseQty'), rect_integer_format)
-                worksheet.write(domestic_shipment_line_start + index, 4, read_field(line_item, 'fields', 'ShipQuantity'), rect_integer_format)
-                worksheet.write_formula(domestic_shipment_line_start + index, 5, '=L{}*D{}'.format(domestic_shipment_line_start + index + 1, domestic_shipment_line_start + index + 1), rect_number_format)
-                worksheet.write_formula(domestic_shipment_line_start + index, 6, '=K{}*D{}'.format(domestic_shipment_line_start + index + 1, domestic_shipment_line_start + index + 1), rect_number_format)
-                worksheet.write(domestic_shipment_line_start + index, 7, read_field(packaging_profile,'fields', 'CartonLengthCM'), rect_integer_format)
-                worksheet.write(domestic_shipment_line_start + index, 8, read_field(packaging_profile,'fields', 'CartonWidthCM'), rect_integer_format)
-                worksheet.write(domestic_shipment_line_start + index, 9, read_field(packaging_profile,'fields', 'CartonHeightCM'), rect_integer_format)
-                worksheet.write_formula(domestic_shipment_line_start + index, 10, '=H{}*I{}*J{}/1000000'.format(domestic_shipment_line_start + index + 1, domestic_shipment_line_start + index + 1, domestic_shipment_line_start + index + 1), rect_number_format)
-                worksheet.write(domestic_shipment_line_start + index, 11, read_field(packaging_profile, 'fields', 'CartonWeightKG'), rect_number_format)
-                worksheet.write(domestic_shipment_line_start + index, 12, read_field(line_item, 'fields', 'BoxMark'), rect_box_format)
-
-            # draw bottom thick border
-            for i in range(12):
-                worksheet.write(domestic_shipment_line_end + 1, i, '', border_thick_top_format)
-
-            domestic_shipment['total_line'] = domestic_shipment_line + 3
-            domestic_shipment_line = domestic_shipment_line_end + 6
-            domestic_shipment['domestic_shipment_line_start'] = domestic_shipment_line_start
-            domestic_shipment['domestic_shipment_line_end'] = domestic_shipment_line_end
-
-
-        # fill in sku information
-        for index, sku in enumerate(skus):
-            worksheet.write(3 + index, 0, sku)
-
-            worksheet.write_formula(3 + index, 1, 
-                '={}'.format(
-                    '+'.join(
-                        [
-                            'SUMIF($A${}:$A${},$A${},$E${}:$E${})'.format(
-                                domestic_shipment['domestic_shipment_line_start'] + 1,
-                                domestic_shipment['domestic_shipment_line_end'] + 1,
-                                4 + index,
-                                domestic_shipment['domestic_shipment_line_start'] + 1,
-                                domestic_shipment['domestic_shipment_line_end'] + 1
-                            ) for domestic_shipment in domestic_shipments
-                        ]
-                    )
-                ), integer_format
-            )
-            worksheet.write_formula(3 + index, 2, 
-                '={}'.format(
-                    '+'.join(
-                        [
-                            'SUMIF($A${}:$A${},$A${},$D${}:$D${})'.format(
-                                domestic_shipment['domestic_shipment_line_start'] + 1,
-                                domestic_shipment['domestic_shipment_line_end'] + 1,
-                                4 + index,
-                                domestic_shipment['domestic_shipment_line_start'] + 1,
-                                domestic_shipment['domestic_shipment_line_end'] + 1
-                            ) for domestic_shipment in domestic_shipments
-                        ]
-                    )
-                ), integer_format
-            )
-
-        worksheet.write(3 + len(skus), 0, '', border_top_format)
-        worksheet.write_formula(3 + len(skus), 1, '=SUM(B4:B{})'.format(3 + len(skus)), workbook.add_format({
-            'top': 1,
-            'num_format': '0'
-        }))
-        worksheet.write_formula(3 + len(skus), 2, '=SUM(C4:C{})'.format(3 + len(skus)), workbook.add_format({
-            'top': 1,
-            'num_format': '0'
-        }))
-
-        # fill in total information
-        
-        # Total KG
-        worksheet.write(3, 5, 'Total KG', workbook.add_format({
+        }),
+        'total_kg_label': workbook.add_format({
             'fg_color': 'yellow',
             'top': 2,
             'left': 2
-        }))
-        worksheet.write_formula(3, 6, '={}'.format('+'.join([
-            '$I${}'.format(
-                domestic_shipment['total_line'] + 1
-            ) for domestic_shipment in domestic_shipments
-        ])), workbook.add_format({
+        }),
+        'total_kg': workbook.add_format({
             'fg_color': 'yellow',
             'num_format': '0.00',
             'right': 2,
             'top': 2
-        }))
-
-        # Total CBM
-        worksheet.write(4, 5, 'Total CBM', workbook.add_format({
+        }),
+        'total_cbm_label': workbook.add_format({
             'fg_color': 'yellow',
             'left': 2
-        }))
-        worksheet.write_formula(4, 6, '={}'.format('+'.join([
-            '$I${}'.format(
-                domestic_shipment['total_line'] + 2
-            ) for domestic_shipment in domestic_shipments
-        ])), workbook.add_format({
+        }),
+        'total_cbm': workbook.add_format({
             'fg_color': 'yellow',
             'num_format': '0.00',
             'right': 2
-        }))
-
-        # Total Carto
-        worksheet.write(5, 5, 'Total Cartons', workbook.add_format({
+        }),
+        'total_cartons_label': workbook.add_format({
             'fg_color': 'yellow',
             'bottom': 2,
             'left': 2
-        }))
-        worksheet.write_formula(5, 6, '={}'.format('+'.join([
-            '$I${}'.format(
-                domestic_shipment['total_line'] + 3
-            ) for domestic_shipment in domestic_shipments
-        ])), workbook.add_format({
+        }),
+        'total_cartons': workbook.add_format({
             'fg_color': 'yellow',
             'right': 2,
             'bottom': 2,
             'num_format': '0',
-        }))
+        })
+    }
+
+
+def write_summary(worksheet, formats, shipment_group, summary):
+    # rows 4 and below hold the sku summary in A:C, the grand totals in F4:G6 and the ship to box in I4:L4.
+    # All of them sum over the line item rows of every block at once, the label and header rows in
+    # between hold text and are skipped by SUM and SUMIF.
+    skus = list(summary['skus'].items())
+    first_line = shipment_group.domestic_shipments[0].domestic_shipment_line_start + 1
+    last_line = shipment_group.domestic_shipments[-1].domestic_shipment_line_end + 1
+
+    for row in range(3, max(6, 4 + len(skus))):
+        index = row - 3
+
+        # fill in sku information
+        if index < len(skus):
+            sku, sku_totals = skus[index]
+            worksheet.write(row, 0, sku)
+            worksheet.write_formula(row, 1, '=SUMIF($A${0}:$A${1},$A${2},$E${0}:$E${1})'.format(first_line, last_line, row + 1), formats['integer'], sku_totals['units'])
+            worksheet.write_formula(row, 2, '=SUMIF($A${0}:$A${1},$A${2},$D${0}:$D${1})'.format(first_line, last_line, row + 1), formats['integer'], sku_totals['cases'])
+        elif index == len(skus):
+            worksheet.write(row, 0, '', formats['border_top'])
+            worksheet.write_formula(row, 1, '=SUM(B4:B{})'.format(row), formats['sku_total'], summary['units'])
+            worksheet.write_formula(row, 2, '=SUM(C4:C{})'.format(row), formats['sku_total'], summary['cases'])
+
+        # fill in total information
+        if row == 3:
+            # Total KG
+            worksheet.write(row, 5, 'Total KG', formats['total_kg_label'])
+            worksheet.write_formula(row, 6, '=SUM($F${}:$F${})'.format(first_line, last_line), formats['total_kg'], summary['kg'])
+        elif row == 4:
+            # Total CBM
+            worksheet.write(row, 5, 'Total CBM', formats['total_cbm_label'])
+            worksheet.write_formula(row, 6, '=SUM($G${}:$G${})'.format(first_line, last_line), formats['total_cbm'], summary['cbm'])
+        elif row == 5:
+            # Total Cartons
+            worksheet.write(row, 5, 'Total Cartons', formats['total_cartons_label'])
+            worksheet.write_formula(row, 6, '=SUM($D${}:$D${})'.format(first_line, last_line), formats['total_cartons'], summary['cases'])
+
+        # Ship To
+        if row == 3:
+            worksheet.write(row, 8, 'Ship To', formats['ship_to_label'])
+            worksheet.write(row, 9, shipment_group.cosignee, formats['ship_to'])
+            worksheet.write(row, 10, '', formats['ship_to'])
+            worksheet.write(row, 11, '', formats['ship_to_end'])
+
+
+def write_domestic_shipment(worksheet, formats, domestic_shipment, cosignee):
+    domestic_shipment_line = domestic_shipment.domestic_shipment_line
+    domestic_shipment_line_start = domestic_shipment.domestic_shipment_line_start
+    domestic_shipment_line_end = domestic_shipment.domestic_shipment_line_end
+    totals = domestic_shipment.totals
+    shipment = domestic_shipment.fulfillment_center
+    address = shipment.address.split(', ', 1)
+
+    # draw top thick border
+    for i in range(12):
+        worksheet.write(domestic_shipment_line - 1, i, '', formats['border_thick_top'])
+
+    # Fulfillment Center
+    worksheet.write(domestic_shipment_line, 0, 'Fulfillment Center')
+    worksheet.write(domestic_shipment_line, 1, shipment.fcid, formats['highlight'])
+    worksheet.write(domestic_shipment_line, 2, '', formats['highlight'])
+
+    # Shipment ID
+    worksheet.write(domestic_shipment_line + 1, 0, 'Shipment ID')
+    worksheet.write(domestic_shipment_line + 1, 1, domestic_shipment.fba_shipment_id, formats['highlight'])
+    worksheet.write(domestic_shipment_line + 1, 2, '', formats['highlight'])
+
+    # Reference ID
+    worksheet.write(domestic_shipment_line + 2, 0, 'Reference ID')
+    worksheet.write(domestic_shipment_line + 2, 1, domestic_shipment.amz_reference_id, formats['highlight'])
+    worksheet.write(domestic_shipment_line + 2, 2, '', formats['highlight'])
+
+    # Ship To
+    worksheet.write(domestic_shipment_line + 3, 0, 'Ship to')
+    worksheet.write_formula(domestic_shipment_line + 3, 1, '=VBA_ShipTo', formats['highlight'], cosignee)
+    worksheet.write(domestic_shipment_line + 3, 2, '', formats['highlight'])
+
+    # Total KG
+    worksheet.write(domestic_shipment_line + 3, 5, 'Total KG 总公斤')
+    worksheet.write_formula(domestic_shipment_line + 3, 8, '=SUM($F${}:$F${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), formats['number'], totals['kg'])
+
+    # Cosignee
+    worksheet.write(domestic_shipment_line + 4, 0, 'Cosignee')
+    worksheet.write(domestic_shipment_line + 4, 1, cosignee, formats['highlight'])
+    worksheet.write(domestic_shipment_line + 4, 2, '', formats['highlight'])
+
+    # Total CBM
+    worksheet.write(domestic_shipment_line + 4, 5, 'Total CBM 总立方米')
+    worksheet.write_formula(domestic_shipment_line + 4, 8, '=SUM($G${}:$G${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), formats['number'], totals['cbm'])
+
+    # Address
+    worksheet.write(domestic_shipment_line + 5, 1, address[0], formats['highlight'])
+    worksheet.write(domestic_shipment_line + 5, 2, '', formats['highlight'])
+
+    # Number of Cases
+    worksheet.write(domestic_shipment_line + 5, 5, 'Number of Cases/箱数量')
+    worksheet.write_formula(domestic_shipment_line + 5, 8, '=SUM($D${}:$D${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), formats['integer'], totals['cases'])
+
+    worksheet.write(domestic_shipment_line + 6, 1, address[1] if len(address) > 1 else '', formats['highlight'])
+    worksheet.write(domestic_shipment_line + 6, 2, '', formats['highlight'])
+
+    # Units Shipped
+    worksheet.write(domestic_shipment_line + 6, 5, 'Units Shipped 订货数量（套）')
+    worksheet.write_formula(domestic_shipment_line + 6, 8, '=SUM($E${}:$E${})'.format(domestic_shipment_line_start + 1, domestic_shipment_line_end + 1), formats['integer'], totals['units'])
+
+    # Country
+    worksheet.write(domestic_shipment_line + 7, 1, shipment.country, formats['highlight'])
+    worksheet.write(domestic_shipment_line + 7, 2, '', formats['highlight'])
+
+    # fill in line items
+    # title
+    for i in range(12):
+        worksheet.write(domestic_shipment_line + 8, i, '箱子规格 / case dimensions' if i == 7 else '', formats['table_header_without_border'])
+
+    # headers
+    worksheet.set_row(domestic_shipment_line + 9, 50)
+    worksheet.write(domestic_shipment_line + 9, 0, 'SKU', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 1, 'FNSKU 条形码编号', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 2, 'Units per Case /外箱包装', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 3, 'Number of Cases/箱数量', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 4, 'Units Shipped 订货数量（套）', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 5, 'Total KG 总公斤', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 6, 'Total CBM 总立方米', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 7, '长 length', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 8, '宽 width', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 9, '高 height', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 10, '总CBM', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 11, 'Weight Per Case 外箱重量', formats['table_header'])
+    worksheet.write(domestic_shipment_line + 9, 12, 'Box Mark分箱号：', formats['box_header'])
+
+    # line item values
+    for index, line_item in enumerate(domestic_shipment.line_items):
+        sku = line_item.sku
+        packaging_profile = line_item.packaging_profile
+        row = domestic_shipment_line_start + index
+
+        worksheet.write(row, 0, sku.sku, formats['rect'])
+        worksheet.write(row, 1, sku.fnsku, formats['rect'])
+        worksheet.write(row, 2, packaging_profile.units_per_carton, formats['rect_integer'])
+        worksheet.write(row, 3, line_item.case_qty, formats['rect_integer'])
+        worksheet.write(row, 4, line_item.ship_quantity, formats['rect_integer'])
+        worksheet.write_formula(row, 5, '=L{}*D{}'.format(row + 1, row + 1), formats['rect_number'], line_item.kg)
+        worksheet.write_formula(row, 6, '=K{}*D{}'.format(row + 1, row + 1), formats['rect_number'], line_item.cbm)
+        worksheet.write(row, 7, packaging_profile.length_cm, formats['rect_integer'])
+        worksheet.write(row, 8, packaging_profile.width_cm, formats['rect_integer'])
+        worksheet.write(row, 9, packaging_profile.height_cm, formats['rect_integer'])
+        worksheet.write_formula(row, 10, '=H{}*I{}*J{}/1000000'.format(row + 1, row + 1, row + 1), formats['rect_number'], line_item.carton_cbm)
+        worksheet.write(row, 11, packaging_profile.weight_kg, formats['rect_number'])
+        worksheet.write(row, 12, line_item.box_mark, formats['rect_box'])
+
+    # draw bottom thick border
+    for i in range(12):
+        worksheet.write(domestic_shipment_line_end + 1, i, '', formats['border_thick_top'])
+
+
+class CellCounter(object):
+    """Worksheet proxy that counts the cells written through it."""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.cells = 0
+
+    def __getattr__(self, name):
+        return getattr(self.worksheet, name)
+
+    def write(self, *args):
+        self.cells += 1
+        return self.worksheet.write(*args)
+
+    def write_formula(self, *args):
+        self.cells += 1
+        return self.worksheet.write_formula(*args)
+
+
+def write_excel_workbook(shipment_group, target, in_memory=False):
+    # write the packing list workbook of shipment_group to target, a file name or file object.
+    # Returns the worksheet, wrapped in a CellCounter. in_memory builds the workbook in memory instead of
+    # flushing finished rows to temporary files, which is faster for small workbooks.
+    import xlsxwriter
+
+    plan_packing_list_layout(shipment_group.domestic_shipments)
+    summary = aggregate_packing_list(shipment_group.domestic_shipments)
+
+    # rows are written strictly top to bottom, so xlsxwriter can flush every finished row to disk
+    workbook = xlsxwriter.Workbook(target, {'in_memory': True} if in_memory else {'constant_memory': True})
+
+    # every formula carries its cached result, so Excel doesn't need to recalculate the whole
+    # sheet on open and viewers that never recalculate still show the totals
+    workbook.calc_on_load = False
+
+    worksheet = CellCounter(workbook.add_worksheet())
+    formats = add_packing_list_formats(workbook)
+
+    # apply styles
+    worksheet.set_column('A:A', 15)
+    worksheet.set_column('B:B', 15)
+    worksheet.set_column('C:C', 13)
+    worksheet.set_column('D:D', 13)
+    worksheet.set_column('E:E', 15)
+    worksheet.set_column('F:F', 13)
+    worksheet.set_column('G:G', 15)
+    worksheet.set_column('L:L', 14)
+    worksheet.set_column('M:M', 20)
+    worksheet.set_row(0, 20)
+    worksheet.set_row(2, 50)
+
+    # fill in basic information
+    worksheet.merge_range('A1:M1', 'Packing List', formats['title'])
+    worksheet.merge_range('A2:C2', 'Shipment Summary', formats['subtitle'])
+
+    worksheet.write('B3', 'Units Shipped 订货数量（套）', formats['text_wrap'])
+    worksheet.write('C3', 'Number of Cases/箱数量', formats['text_wrap'])
+    workbook.define_name('VBA_ShipTo', '=Sheet1!$J$4')
+
+    write_summary(worksheet, formats, shipment_group, summary)
+
+    # loop through all domestic shipments
+    for domestic_shipment in shipment_group.domestic_shipments:
+        write_domestic_shipment(worksheet, formats, domestic_shipment, shipment_group.cosignee)
+
+    workbook.close()
+    return worksheet
+
+
+def generate_excel_file(shipment_group, file_name=None, output=None):
+    # writes to file_name or to the file object output when given, otherwise returns the xlsx bytes
+    try: 
+        # Create an new Excel file and add a worksheet.
+        print('##### Generating packaging list started #####')
+        in_memory = file_name is None and output is None
+        if in_memory:
+            output = BytesIO()
+        worksheet = write_excel_workbook(shipment_group, file_name or output)
+
+        metrics.increment('rows_written', worksheet.dim_rowmax + 1)
+        metrics.increment('cells_written', worksheet.cells)
+        if in_memory:
+            metrics.increment('workbook_bytes', output.tell())
+        elif file_name:
+            metrics.increment('workbook_bytes', os.path.getsize(file_name))
+        elif hasattr(output, 'size'):
+            metrics.increment('workbook_bytes', output.size)
 
-        workbook.close()
-        
         print('##### Generating packaging list finished #####')
-        return output.getvalue()
+        if in_memory:
+            return output.getvalue()
+    except Exception as e:
+        print('Error generating packaging list: ' + str(e))
+        raise ValueError('Error generating packaging list: ' + str(e))
+
+
+def render_excel_file(shipment_group):
+    # generate_excel_file for a worker process, whose metrics are lost with it: returns the xlsx bytes
+    # and the rows and cells written, for the caller to count
+    try:
+        output = BytesIO()
+        worksheet = write_excel_workbook(shipment_group, output)
+        return output.getvalue(), worksheet.dim_rowmax + 1, worksheet.cells
+    except Exception as e:
+        raise ValueError('Error generating packaging list: ' + str(e))
+
+
+def generate_export_file(shipment_group, output_format, file_name=None, output=None, domestic_shipments=None):
+    # the packing list content as csv, jsonl or parquet rows, see exports.py. Writes to file_name or
+    # to the file object output when given, otherwise returns the file bytes. domestic_shipments can be
+    # the generator of stream_shipment_group_from_airtable, every shipment is then written as it arrives.
+    try:
+        print('##### Generating packaging list export started #####')
+        in_memory = file_name is None and output is None
+        if in_memory:
+            output = BytesIO()
+        if domestic_shipments is None:
+            domestic_shipments = shipment_group.domestic_shipments
+        summary = packing_list_summary()
+        domestic_shipments = aggregate_while_iterating(domestic_shipments, summary)
+        if file_name:
+            with open(file_name, 'wb') as f:
+                write_export(shipment_group, domestic_shipments, summary, output_format, f)
+            metrics.increment('export_bytes', os.path.getsize(file_name))
+        else:
+            write_export(shipment_group, domestic_shipments, summary, output_format, output)
+            if in_memory:
+                metrics.increment('export_bytes', output.tell())
+            elif hasattr(output, 'size'):
+                metrics.increment('export_bytes', output.size)
+
+        print('##### Generating packaging list export finished #####')
+        if in_memory:
+            return output.getvalue()
+    except Exception as e:
+        print('Error generating packaging list export: ' + str(e))
+        raise ValueError('Error generating packaging list export: ' + str(e))
+
+
+RENDER_MAX_WORKERS = os.cpu_count() or 1
+# the workers are forked from a forkserver rather than from the handler: by the time they start, the lease
+# renewers, the multipart upload and the upload executor have threads running, and a fork could copy
+# their held locks into the workers. spawn works too, but imports the handler again for every worker.
+RENDER_START_METHOD = os.getenv('RENDER_START_METHOD', 'forkserver')
+
+def process_worker(connection, func, args):
+    try:
+        connection.send((True, func(*args)))
+    except Exception as e:
+        connection.send((False, str(e)))
+    finally:
+        connection.close()
+
+def run_in_processes(func, args_list, max_workers=RENDER_MAX_WORKERS):
+    # Lambda has no /dev/shm, which multiprocessing.Pool and ProcessPoolExecutor need for their queues,
+    # so every call gets its own process and pipe. func has to be a module level function of the handler,
+    # it and args are pickled for the worker. Yields (index, ok, result or error message) in completion order.
+    # Workers still running when the caller stops early, e.g. on the first error, are terminated.
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    context = multiprocessing.get_context(RENDER_START_METHOD)
+    if RENDER_START_METHOD == 'forkserver':
+        # the forkserver starts once per container, with the handler imported for every worker it forks.
+        # Scripts that render have to guard their entry point with if __name__ == '__main__'.
+        context.set_forkserver_preload(['handler'])
+    pending = list(enumerate(args_list))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < max_workers:
+                index, args = pending.pop(0)
+                parent_connection, child_connection = context.Pipe(duplex=False)
+                process = context.Process(target=process_worker, args=(child_connection, func, args))
+                process.start()
+                child_connection.close()
+                running[parent_connection] = (index, process)
+
+            for connection in wait(list(running)):
+                index, process = running.pop(connection)
+                try:
+                    ok, result = connection.recv()
+                except EOFError:
+                    ok, result = False, 'Worker process died'
+                connection.close()
+                process.join()
+                yield index, ok, result
+    finally:
+        for connection, (index, process) in running.items():
+            process.terminate()
+            process.join()
+            connection.close()
+
+
+# Sharded rendering for huge groups: the packing list as a zip of one workbook per domestic shipment, each
+# laid out like a packing list of its own, plus a summary workbook with the totals of every shipment and of
+# the whole group. The shipment workbooks are rendered in worker processes, in shards of contiguous
+# shipments. xlsxwriter writes a workbook from a single process, so the shards are separate workbooks
+# rather than sheets of one.
+SHARDED_FORMAT = 'zip'
+SHARDED_CONTENT_TYPE = 'application/zip'
+SHARD_LINE_ITEMS = int(os.getenv('SHARD_LINE_ITEMS', 5000))
+SHARD_SUMMARY_NAME = 'Summary.xlsx'
+
+def shard_domestic_shipments(domestic_shipments, line_items=SHARD_LINE_ITEMS, shards=1):
+    # contiguous (start, stop) ranges of domestic_shipments with at most about line_items line items each,
+    # and at least shards of them when there are as many shipments, so every worker gets one
+    shards = min(shards, len(domestic_shipments))
+    if shards:
+        line_items = min(line_items, max(1, -(-sum(len(domestic_shipment.line_items) for domestic_shipment in domestic_shipments) // shards)))
+    ranges = []
+    start = count = 0
+    for index, domestic_shipment in enumerate(domestic_shipments):
+        count += len(domestic_shipment.line_items)
+        # the shipments left are split one per range when there are no more of them than ranges missing
+        if count >= line_items or len(domestic_shipments) - index - 1 <= shards - len(ranges) - 1:
+            ranges.append((start, index + 1))
+            start, count = index + 1, 0
+    if start < len(domestic_shipments):
+        ranges.append((start, len(domestic_shipments)))
+    return ranges
+
+def domestic_shipment_file_name(domestic_shipment, index, count):
+    # numbered in the order of the group of count shipments, so the files sort like the blocks of the
+    # single workbook
+    name = re.sub(r'[^\w.-]+', '_', str(domestic_shipment.fba_shipment_id or domestic_shipment.id))
+    return '{} {}.xlsx'.format(str(index + 1).zfill(len(str(count))), name)
+
+def render_shard(shipment_group, start, count):
+    # runs in a worker process: the workbooks of the domestic shipments of shipment_group, a shard starting
+    # at index start of a group of count shipments, as (file name, bytes), and the rows and cells written
+    workbooks = []
+    rows = cells = 0
+    for index, domestic_shipment in enumerate(shipment_group.domestic_shipments, start):
+        output = BytesIO()
+        worksheet = write_excel_workbook(
+            ShipmentGroup(shipment_group.id, shipment_group.cosignee, [domestic_shipment]),
+            output,
+            in_memory=True
+        )
+        workbooks.append((domestic_shipment_file_name(domestic_shipment, index, count), output.getvalue()))
+        rows += worksheet.dim_rowmax + 1
+        cells += worksheet.cells
+    return workbooks, rows, cells
+
+def write_sharded_summary(shipment_group, summary, target):
+    # the summary workbook of a sharded packing list: one row per shipment workbook with its totals, then
+    # the SKU summary of the whole group. The totals rows sum the rows above them.
+    import xlsxwriter
+
+    domestic_shipments = shipment_group.domestic_shipments
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True})
+    workbook.calc_on_load = False
+    worksheet = CellCounter(workbook.add_worksheet('Summary'))
+    formats = add_packing_list_formats(workbook)
+    number_total = workbook.add_format({'top': 1, 'num_format': '0.00'})
+
+    worksheet.set_column('A:A', 24)
+    worksheet.set_column('B:D', 15)
+    worksheet.set_column('E:H', 13)
+    worksheet.set_row(0, 20)
+    worksheet.merge_range('A1:H1', 'Packing List', formats['title'])
+
+    worksheet.write(1, 0, 'Ship To', formats['ship_to_label'])
+    worksheet.write(1, 1, shipment_group.cosignee, formats['ship_to'])
+    worksheet.write(1, 2, '', formats['ship_to_end'])
+
+    # shipments
+    worksheet.set_row(3, 50)
+    headers = (
+        'File', 'Fulfillment Center', 'Shipment ID', 'Reference ID', 'Number of Cases/箱数量',
+        'Units Shipped 订货数量（套）', 'Total KG 总公斤', 'Total CBM 总立方米'
+    )
+    for column, header in enumerate(headers):
+        worksheet.write(3, column, header, formats['table_header'])
+    row = 4
+    for index, domestic_shipment in enumerate(domestic_shipments):
+        totals = domestic_shipment.totals
+        worksheet.write(row, 0, domestic_shipment_file_name(domestic_shipment, index, len(domestic_shipments)), formats['rect'])
+        worksheet.write(row, 1, domestic_shipment.fulfillment_center.fcid, formats['rect'])
+        worksheet.write(row, 2, domestic_shipment.fba_shipment_id, formats['rect'])
+        worksheet.write(row, 3, domestic_shipment.amz_reference_id, formats['rect'])
+        worksheet.write(row, 4, totals['cases'], formats['rect_integer'])
+        worksheet.write(row, 5, totals['units'], formats['rect_integer'])
+        worksheet.write(row, 6, totals['kg'], formats['rect_number'])
+        worksheet.write(row, 7, totals['cbm'], formats['rect_number'])
+        row += 1
+    worksheet.write(row, 0, 'Total', formats['border_top'])
+    for column in range(1, 4):
+        worksheet.write(row, column, '', formats['border_top'])
+    worksheet.write_formula(row, 4, '=SUM(E5:E{})'.format(row), formats['sku_total'], summary['cases'])
+    worksheet.write_formula(row, 5, '=SUM(F5:F{})'.format(row), formats['sku_total'], summary['units'])
+    worksheet.write_formula(row, 6, '=SUM(G5:G{})'.format(row), number_total, summary['kg'])
+    worksheet.write_formula(row, 7, '=SUM(H5:H{})'.format(row), number_total, summary['cbm'])
+
+    # SKU summary
+    row += 2
+    worksheet.merge_range(row, 0, row, 2, 'Shipment Summary', formats['subtitle'])
+    worksheet.set_row(row + 1, 50)
+    worksheet.write(row + 1, 1, 'Units Shipped 订货数量（套）', formats['text_wrap'])
+    worksheet.write(row + 1, 2, 'Number of Cases/箱数量', formats['text_wrap'])
+    row += 2
+    first_sku = row + 1
+    for sku, sku_totals in summary['skus'].items():
+        worksheet.write(row, 0, sku)
+        worksheet.write(row, 1, sku_totals['units'], formats['integer'])
+        worksheet.write(row, 2, sku_totals['cases'], formats['integer'])
+        row += 1
+    worksheet.write(row, 0, '', formats['border_top'])
+    worksheet.write_formula(row, 1, '=SUM(B{}:B{})'.format(first_sku, row), formats['sku_total'], summary['units'])
+    worksheet.write_formula(row, 2, '=SUM(C{}:C{})'.format(first_sku, row), formats['sku_total'], summary['cases'])
+
+    workbook.close()
+    return worksheet
+
+def generate_sharded_excel_file(shipment_group, output):
+    # writes the sharded packing list zip of shipment_group to the file object output
+    import zipfile
+
+    try:
+        print('##### Generating sharded packaging list started #####')
+        summary = aggregate_packing_list(shipment_group.domestic_shipments)
+        domestic_shipments = shipment_group.domestic_shipments
+        shards = shard_domestic_shipments(domestic_shipments, SHARD_LINE_ITEMS, RENDER_MAX_WORKERS)
+        # xlsx files are zip compressed already, so they are stored as they are
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+            workbook = BytesIO()
+            worksheet = write_sharded_summary(shipment_group, summary, workbook)
+            archive.writestr(SHARD_SUMMARY_NAME, workbook.getvalue())
+            metrics.increment('rows_written', worksheet.dim_rowmax + 1)
+            metrics.increment('cells_written', worksheet.cells)
+
+            # the zip is written in the order the shards finish. A worker only gets the shipments of its shard.
+            with closing(run_in_processes(render_shard, [
+                (ShipmentGroup(shipment_group.id, shipment_group.cosignee, domestic_shipments[start:stop]), start, len(domestic_shipments))
+                for start, stop in shards
+            ])) as results:
+                for index, ok, result in results:
+                    if not ok:
+                        raise ValueError(result)
+                    workbooks, rows, cells = result
+                    for file_name, data in workbooks:
+                        archive.writestr(file_name, data)
+                    metrics.increment('rows_written', rows)
+                    metrics.increment('cells_written', cells)
+        metrics.increment('shards', len(shards))
+        if hasattr(output, 'size'):
+            metrics.increment('workbook_bytes', output.size)
+        print('##### Generating sharded packaging list finished #####')
     except Exception as e:
         print('Error generating packaging list: ' + str(e))
         raise ValueError('Error generating packaging list: ' + str(e))
 
 
+# S3 multipart parts must be at least 5 MiB, except for the last one. Smaller files can't overlap their
+# upload with being written.
+S3_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_CONCURRENT_PARTS = 4
+
+class S3MultipartUpload(object):
+    """Write-only file object that uploads everything written to it to S3 in multipart chunks.
+
+    Parts are sent in the background as soon as enough data is buffered, so the upload
+    overlaps with the workbook being written. Files smaller than one part are sent with a
+    single put_object on close(). Parts and small files are sent from the buffer they were
+    written to, without copying it.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=S3_PART_SIZE, **extra_args):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self.executor = None
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            # the buffer itself becomes the part, only what was written past it is copied into the next one
+            body, self.buffer = self.buffer, self.buffer[self.part_size:]
+            del body[self.part_size:]
+            self.upload_part(body)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENT_PARTS)
+
+        # keep at most S3_MAX_CONCURRENT_PARTS buffered parts in memory
+        in_flight = [future for part_number, future in self.parts if not future.done()]
+        if len(in_flight) >= S3_MAX_CONCURRENT_PARTS:
+            in_flight[0].result()
+
+        part_number = len(self.parts) + 1
+        future = self.executor.submit(
+            self.s3_client.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        self.parts.append((part_number, future))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.s3_client.put_object(Body=self.buffer, Bucket=self.bucket, Key=self.key, **self.extra_args)
+            self.buffer = bytearray()
+            return
+
+        try:
+            if self.buffer:
+                self.upload_part(self.buffer)
+                self.buffer = bytearray()
+            parts = [{'PartNumber': part_number, 'ETag': future.result()['ETag']} for part_number, future in self.parts]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        # drop the uploaded parts so a failed generation leaves nothing billable behind
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is None:
+            return
+        self.executor.shutdown()
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print('Error aborting multipart upload: ' + str(e))
+        self.upload_id = None
+
+
+# Bump whenever the workbook layout changes, so packing lists generated by older code aren't reused
+PACKING_LIST_VERSION = 2
+FINGERPRINT_PREFIX = 'fingerprints/'
+# clock skew allowance between Lambda and Airtable for the last modified precheck
+FINGERPRINT_PRECHECK_MARGIN = float(os.getenv('CLOCK_SKEW_MARGIN', 60))
+CHANGE_TRACKED_TABLES = ('Domestic Shipments', 'DomesticShipmentLineItem', 'SKUS', 'PackagingProfile', 'FCList')
+# modified records the precheck compares with the records of a packing list, more count as a change
+CHANGE_PRECHECK_MAX_RECORDS = 100
+
+def fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def fingerprint_packing_list_data(shipment_group):
+    # stable hash of all resolved data the packing list is rendered from
+    return fingerprint([PACKING_LIST_VERSION, shipment_group.as_dict()])
+
+def fingerprint_shipment_group(domestic_shipment_ids, cosignee):
+    # hash of the shipment group fields the packing list depends on
+    return fingerprint([domestic_shipment_ids, cosignee])
+
+def packing_list_record_ids(shipment_group):
+    # ids of every record a packing list is built from
+    record_ids = {shipment_group.id}
+    for domestic_shipment in shipment_group.domestic_shipments:
+        record_ids.add(domestic_shipment.id)
+        if domestic_shipment.fulfillment_center.id:
+            record_ids.add(domestic_shipment.fulfillment_center.id)
+        for line_item in domestic_shipment.line_items:
+            record_ids.update((line_item.id, line_item.sku.id, line_item.packaging_profile.id))
+    return sorted(record_ids)
+
+def fingerprint_packing_list(shipment_group, checked):
+    # the fingerprint stored with a packing list, checked is when its data was fetched. Reference records
+    # served from reference_cache were fetched earlier, the precheck looks for changes to the reference
+    # tables since referencesChecked instead.
+    references_checked = checked
+    if shipment_group.fetched is not None:
+        references_checked = min(checked, shipment_group.fetched)
+    return {
+        'fingerprint': fingerprint_packing_list_data(shipment_group),
+        'shipmentGroup': fingerprint_shipment_group(
+            [domestic_shipment.id for domestic_shipment in shipment_group.domestic_shipments],
+            shipment_group.cosignee
+        ),
+        'records': packing_list_record_ids(shipment_group),
+        'checked': checked,
+        'referencesChecked': references_checked
+    }
+
+def fingerprint_key(record_id, output_format='xlsx'):
+    # every output format keeps its own fingerprint and download
+    if output_format == 'xlsx':
+        return FINGERPRINT_PREFIX + record_id + '.json'
+    return FINGERPRINT_PREFIX + record_id + '.' + output_format + '.json'
+
+def get_packing_list_fingerprint(s3_client, record_id, output_format='xlsx'):
+    try:
+        response = s3_client.get_object(Bucket=os.getenv('BUCKET_NAME'), Key=fingerprint_key(record_id, output_format))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+def put_packing_list_fingerprint(s3_client, record_id, packing_list_fingerprint, output_format='xlsx'):
+    s3_client.put_object(
+        Body=json.dumps(packing_list_fingerprint).encode('utf-8'),
+        Bucket=os.getenv('BUCKET_NAME'),
+        Key=fingerprint_key(record_id, output_format),
+        ContentType='application/json'
+    )
+
+def request_modified_records(executor, table, timestamp, max_records, fields=None):
+    # start fetching the records of table modified after timestamp, with fields or only the first one
+    since = datetime.utcfromtimestamp(timestamp - FINGERPRINT_PRECHECK_MARGIN).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    return executor.submit(
+        airtable_get_all,
+        table,
+        formula="IS_AFTER(LAST_MODIFIED_TIME(),'{}')".format(since),
+        fields=fields or AIRTABLE_FIELDS[table.table_name][:1],
+        max_records=max_records
+    )
+
+def shipment_group_changed_since(app_id, secret_key, shipment_group_id, shipment_group_fingerprint, timestamp, record_ids=None,
+                                 references_timestamp=None):
+    # cheap conservative check whether anything a packing list could be built from changed after timestamp:
+    # the group's own fields are compared directly, the other tables are asked for the records modified since.
+    # The reference tables are asked from references_timestamp when given, the packing list may have been
+    # built from cached reference records fetched before timestamp. Given record_ids, the records the packing
+    # list was built from, only changes to those count, otherwise any change does. It costs one request per
+    # table regardless of the size of the group.
+    tbl_shipment_group = airtable_table(app_id, 'ShipmentGroup', secret_key)
+    max_records = CHANGE_PRECHECK_MAX_RECORDS if record_ids is not None else 1
+
+    with ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS) as executor:
+        shipment_group = executor.submit(
+            airtable_get_all,
+            tbl_shipment_group,
+            formula=record_id_formula([shipment_group_id]),
+            fields=AIRTABLE_FIELDS['ShipmentGroup']
+        )
+        changes = OrderedDict(
+            (table_name, request_modified_records(
+                executor,
+                airtable_table(app_id, table_name, secret_key),
+                references_timestamp if table_name in REFERENCE_TABLES and references_timestamp is not None else timestamp,
+                max_records
+            )) for table_name in CHANGE_TRACKED_TABLES
+        )
+        shipment_group = shipment_group.result()
+        modified = OrderedDict((table_name, [record['id'] for record in change.result()]) for table_name, change in changes.items())
+
+    # modified reference records are fetched again rather than served from reference_cache
+    for table_name in REFERENCE_TABLES:
+        if modified[table_name]:
+            reference_cache.invalidate(table_name, modified[table_name])
+
+    if not shipment_group:
+        return True
+    if record_ids is None:
+        if any(modified.values()):
+            return True
+    else:
+        record_ids = set(record_ids)
+        changed = [
+            table_name for table_name, ids in modified.items() if len(ids) >= max_records or record_ids.intersection(ids)
+        ]
+        if any(table_name in REFERENCE_TABLES for table_name in changed):
+            # every reference record of the packing list is fetched again, with some still served from the
+            # cache the next precheck would go back to before this change and find it again
+            for table_name in REFERENCE_TABLES:
+                reference_cache.invalidate(table_name, record_ids)
+        if changed:
+            return True
+
+    shipment_group = shipment_group[0]
+    return fingerprint_shipment_group(
+        shipment_group['fields'].get('DomesticShipments', []),
+        field(shipment_group, 'Cosignee Name')
+    ) != shipment_group_fingerprint
+
+
 def create(event, context):
     print("Request Body: ")
     print(event["body"])
@@ -451,42 +1635,615 @@ def create(event, context):
             })
         }
 
+    metrics.reset()
+    try:
+        if body.get('invalidateCache'):
+            reference_cache.invalidate()
+
+        check_output_format(body.get('format', 'xlsx'))
+        # large groups can take longer than the API Gateway timeout, let a worker generate them instead
+        if body.get('async'):
+            job = submit_job(get_job_queue(), get_job_store(), body['recordId'], force=body.get('force', False), output_format=body.get('format', 'xlsx'))
+            return {
+                "statusCode": 202,
+                "headers": {
+                    "Access-Control-Allow-Origin": "*"
+                },
+                "body": json.dumps({
+                    "message": "The packaging list is being generated",
+                    "jobId": job['jobId'],
+                    "status": job['status']
+                })
+            }
+
+        with metrics.timer('total'):
+            download, reused, coalesced = generate_packaging_list_coalesced(
+                aws_client('s3'),
+                body['recordId'],
+                force=body.get('force', False),
+                output_format=body.get('format', 'xlsx')
+            )
+
+        if reused:
+            message = "The packaging list is up to date"
+        elif body.get('format', 'xlsx') == 'xlsx':
+            message = "A new packaging list is generated and attached to the Airtable"
+        else:
+            message = "A new packaging list export is generated"
+        response = {
+            "message": message,
+            "download": download,
+            "reused": reused,
+            "coalesced": coalesced
+        }
+        if body.get('debug'):
+            response['debug'] = metrics.as_dict()
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps(response)
+        }
+    except Exception as e:
+        print(e)
+        return {
+            "statusCode": 500,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({
+                "error": "Error occured",
+                "message": str(e)
+            })
+        }
+    finally:
+        metrics.emit('create')
+
+
+UPLOAD_MAX_WORKERS = 8
+
+def packing_list_url(object_name):
+    return "https://{}.s3.amazonaws.com/{}".format(os.getenv('BUCKET_NAME'), object_name)
+
+@contextmanager
+def pipeline_stage(name, progress):
+    # report the stage to the job progress callback and time it
+    progress(name)
+    with metrics.timer(name):
+        yield
+
+def attach_packing_list(shipment_group_id, list_url):
+    # attach a packing list generated earlier, with the attachments the shipment group has now
+    tbl_shipment_group = airtable_table(os.getenv('AIRTABLE_APP_ID'), 'ShipmentGroup', os.getenv('AIRTABLE_SECRET_KEY'))
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        shipment_groups, = get_records_by_ids(executor, (tbl_shipment_group, [shipment_group_id]))
+    upload_packaging_list_to_airtable(
+        os.getenv('AIRTABLE_APP_ID'),
+        os.getenv('AIRTABLE_SECRET_KEY'),
+        ShipmentGroup.from_record(shipment_groups[shipment_group_id], []),
+        list_url
+    )
+
+def check_output_format(output_format):
+    if output_format not in ('xlsx', SHARDED_FORMAT) and output_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown output format: ' + str(output_format))
+    check_export_format(output_format)
+
+def generate_packaging_list(s3_client, record_id, progress=None, force=False, output_format='xlsx', attach=True):
+    # fetch, render, upload and attach the packing list of one shipment group. Returns its download url and
+    # whether an earlier packing list generated from the same data was reused instead.
+    # progress is called with the name of every stage as it starts. Machine-readable output formats
+    # (see exports.py) are rendered without xlsxwriter, they and the sharded zip are not attached to the
+    # shipment group. Without attach an xlsx isn't either, its fingerprint remembers that so the next call
+    # that reuses it attaches it.
+    check_output_format(output_format)
+    progress = progress or (lambda stage: None)
+    object_name = '{}.{}'.format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), output_format)
+    fetched_at = time.time()
+    previous = None if force else get_packing_list_fingerprint(s3_client, record_id, output_format)
+
+    if previous:
+        with pipeline_stage('precheck', progress):
+            changed = shipment_group_changed_since(
+                os.getenv('AIRTABLE_APP_ID'),
+                os.getenv('AIRTABLE_SECRET_KEY'),
+                record_id,
+                previous['shipmentGroup'],
+                previous['checked'],
+                previous.get('records'),
+                previous.get('referencesChecked')
+            )
+        if not changed:
+            print('##### Nothing changed since the last packaging list was generated #####')
+            # the data is current as of this precheck, so the next one only has to look for changes since
+            previous['checked'] = previous['referencesChecked'] = fetched_at
+            if attach and not previous.get('attached', True):
+                with pipeline_stage('attach', progress):
+                    attach_packing_list(record_id, previous['download'])
+                previous['attached'] = True
+            put_packing_list_fingerprint(s3_client, record_id, previous, output_format)
+            return previous['download'], True
+
+    # the fetch is timed by the stream, as it overlaps with rendering when the shipments are streamed
+    progress('fetch')
+    shipment_group, domestic_shipments = stream_shipment_group_from_airtable(os.getenv('AIRTABLE_APP_ID'), os.getenv('AIRTABLE_SECRET_KEY'), record_id)
+    packing_list_fingerprint = None
+    # exports are written while the shipments arrive and compared with an earlier packing list once they
+    # are all in. The xlsx layout needs every shipment before the first block: the SKU summary above the
+    # blocks decides the row they start at. The sharded workbooks are rendered once the whole group is
+    # fetched, the summary needs the totals of every shipment.
+    if output_format in ('xlsx', SHARDED_FORMAT):
+        for domestic_shipment in domestic_shipments:
+            pass
+        domestic_shipments = None
+        packing_list_fingerprint = fingerprint_packing_list(shipment_group, fetched_at)
+
+        if previous and previous['fingerprint'] == packing_list_fingerprint['fingerprint']:
+            print('##### Packaging list data is unchanged, reusing ', previous['download'], ' #####')
+            packing_list_fingerprint['download'] = previous['download']
+            if 'attached' in previous:
+                packing_list_fingerprint['attached'] = previous['attached']
+            if attach and not previous.get('attached', True):
+                with pipeline_stage('attach', progress):
+                    upload_packaging_list_to_airtable(
+                        os.getenv('AIRTABLE_APP_ID'),
+                        os.getenv('AIRTABLE_SECRET_KEY'),
+                        shipment_group,
+                        previous['download']
+                    )
+                packing_list_fingerprint['attached'] = True
+            put_packing_list_fingerprint(s3_client, record_id, packing_list_fingerprint, output_format)
+            return previous['download'], True
+
+    # the file is streamed to S3 while it is being written
+    print('##### Putting generated packaging list to S3 started. Object name: ', object_name, ' #####')
+    if output_format == 'xlsx':
+        upload = S3MultipartUpload(s3_client, os.getenv('BUCKET_NAME'), object_name, ACL='public-read')
+    elif output_format == SHARDED_FORMAT:
+        upload = S3MultipartUpload(s3_client, os.getenv('BUCKET_NAME'), object_name, ACL='public-read', ContentType=SHARDED_CONTENT_TYPE)
+    else:
+        upload = S3MultipartUpload(s3_client, os.getenv('BUCKET_NAME'), object_name, ACL='public-read', ContentType=EXPORT_FORMATS[output_format])
+    try:
+        with pipeline_stage('render', progress):
+            if output_format == 'xlsx':
+                generate_excel_file(shipment_group, output=upload)
+            elif output_format == SHARDED_FORMAT:
+                generate_sharded_excel_file(shipment_group, upload)
+            else:
+                generate_export_file(shipment_group, output_format, output=upload, domestic_shipments=domestic_shipments)
+
+        if packing_list_fingerprint is None:
+            packing_list_fingerprint = fingerprint_packing_list(shipment_group, fetched_at)
+            if previous and previous['fingerprint'] == packing_list_fingerprint['fingerprint']:
+                # the export was written for nothing, the parts sent so far are dropped
+                upload.abort()
+                print('##### Packaging list data is unchanged, reusing ', previous['download'], ' #####')
+                packing_list_fingerprint['download'] = previous['download']
+                put_packing_list_fingerprint(s3_client, record_id, packing_list_fingerprint, output_format)
+                return previous['download'], True
+        with pipeline_stage('upload', progress):
+            upload.close()
+    except Exception:
+        upload.abort()
+        raise
+    print('##### Putting generated packaging list to S3 finished #####')
+
+    if output_format == 'xlsx' and attach:
+        with pipeline_stage('attach', progress):
+            upload_packaging_list_to_airtable(
+                os.getenv('AIRTABLE_APP_ID'),
+                os.getenv('AIRTABLE_SECRET_KEY'),
+                shipment_group,
+                packing_list_url(object_name)
+            )
+
+    packing_list_fingerprint['download'] = packing_list_url(object_name)
+    if output_format == 'xlsx':
+        packing_list_fingerprint['attached'] = attach
+    put_packing_list_fingerprint(s3_client, record_id, packing_list_fingerprint, output_format)
+    return packing_list_url(object_name), False
+
+def packing_list_lease_key(record_id, output_format):
+    return 'packing-list:{}:{}'.format(record_id, output_format)
+
+def generate_packaging_list_coalesced(s3_client, record_id, progress=None, force=False, output_format='xlsx', attach=True):
+    # generate_packaging_list, but concurrent calls for the same shipment group and format share a single
+    # generation instead of each fetching, rendering and attaching their own. A forced call only joins
+    # another forced one, and one that attaches only another that attaches. Returns the download url,
+    # whether it was reused and whether the call was joined.
+    result, joined = single_flight(
+        get_lease_store(),
+        packing_list_lease_key(record_id, output_format),
+        lambda: generate_packaging_list(s3_client, record_id, progress, force, output_format, attach),
+        data={'force': force, 'attach': attach},
+        join=lambda data: (data['force'] or not force) and (data.get('attach', True) or not attach)
+    )
+    if joined:
+        print('##### Joined a concurrent generation of the packaging list #####')
+        metrics.increment('coalesced_requests')
+    download, reused = result
+    return download, reused, joined
+
+def upload_packaging_list(s3_client, object_name, packaging_list):
+    upload = S3MultipartUpload(s3_client, os.getenv('BUCKET_NAME'), object_name, ACL='public-read')
+    upload.write(packaging_list)
+    upload.close()
+    return packing_list_url(object_name)
+
+def create_batch(event, context):
+    print("Request Body: ")
+    print(event["body"])
+
+    try:
+        body = json.loads(event["body"])
+    except Exception as e:
+        print(e)
+        return {
+            "statusCode": 500,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({
+                "error": "Error occured",
+                "message": str(e)
+            })
+        }
+
+    metrics.reset()
+    leases = None
     try:
-        import boto3
-        
-        s3_client = boto3.client('s3')
-        object_name = '{}.xlsx'.format(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        
-        packaging_list = generate_excel_file(
-            get_domestic_shipments_from_airtable(os.getenv('AIRTABLE_APP_ID'), os.getenv('AIRTABLE_SECRET_KEY'), body['recordId'])
+        s3_client = aws_client('s3')
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        fetched_at = time.time()
+        record_ids = list(dict.fromkeys(body['recordIds']))
+        results = OrderedDict((record_id, {}) for record_id in record_ids)
+
+        # the leases of generate_packaging_list_coalesced: a concurrent create of a group in the batch waits
+        # for it instead of attaching a packing list of its own, groups being generated already are skipped
+        leases = BatchLeases(
+            get_lease_store(),
+            [packing_list_lease_key(record_id, 'xlsx') for record_id in record_ids],
+            data={'force': bool(body.get('force')), 'attach': True}
         )
+        for record_id in record_ids:
+            if packing_list_lease_key(record_id, 'xlsx') not in leases.acquired:
+                results[record_id] = {'error': 'The packaging list is already being generated'}
+        record_ids = [record_id for record_id in record_ids if not results[record_id]]
+
+        # every SKU, profile and FC shared between the groups is fetched only once
+        with metrics.timer('fetch'):
+            shipment_groups, errors = get_shipment_groups_from_airtable(os.getenv('AIRTABLE_APP_ID'), os.getenv('AIRTABLE_SECRET_KEY'), record_ids)
+        for record_id, error in errors.items():
+            results[record_id] = {'error': 'Error getting domestic shipments from Airtable: ' + error}
+
+        with metrics.timer('render_and_upload'), ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+            # groups whose data didn't change since their last packing list reuse it, a pre-generated one
+            # is attached along with the new ones
+            fingerprints = {}
+            unattached = []
+            previous_fingerprints = dict(zip(shipment_groups, executor.map(
+                lambda record_id: None if body.get('force') else get_packing_list_fingerprint(s3_client, record_id),
+                shipment_groups
+            )))
+            for record_id, shipment_group in shipment_groups.items():
+                fingerprints[record_id] = fingerprint_packing_list(shipment_group, fetched_at)
+                previous = previous_fingerprints[record_id]
+                if previous and previous['fingerprint'] == fingerprints[record_id]['fingerprint']:
+                    fingerprints[record_id]['download'] = previous['download']
+                    fingerprints[record_id]['attached'] = previous.get('attached', True)
+                    if not fingerprints[record_id]['attached']:
+                        unattached.append(record_id)
+                    else:
+                        executor.submit(put_packing_list_fingerprint, s3_client, record_id, fingerprints[record_id])
+                    results[record_id] = {'download': previous['download'], 'reused': True}
+
+            # render the workbooks in parallel processes and upload each one as soon as it is ready
+            record_ids = [record_id for record_id in shipment_groups if not results[record_id]]
+            futures = OrderedDict()
+            rendered = run_in_processes(render_excel_file, [(shipment_groups[record_id],) for record_id in record_ids])
+            with metrics.timer('render'), closing(rendered):
+                for index, ok, result in rendered:
+                    record_id = record_ids[index]
+                    if not ok:
+                        results[record_id] = {'error': result}
+                        continue
+                    workbook, rows, cells = result
+                    metrics.increment('rows_written', rows)
+                    metrics.increment('cells_written', cells)
+                    metrics.increment('workbook_bytes', len(workbook))
+                    object_name = '{} {}.xlsx'.format(timestamp, record_id)
+                    futures[record_id] = executor.submit(upload_packaging_list, s3_client, object_name, workbook)
+
+            # attach the uploaded packing lists with batch updates, 10 shipment groups per request
+            updates = AirtableUpdateQueue(airtable_table(os.getenv('AIRTABLE_APP_ID'), 'ShipmentGroup', os.getenv('AIRTABLE_SECRET_KEY')))
+            for record_id in unattached:
+                updates.add(record_id, packing_lists_update(shipment_groups[record_id], results[record_id]['download']))
+            for record_id, future in futures.items():
+                try:
+                    download = future.result()
+                except Exception as e:
+                    print(e)
+                    results[record_id] = {'error': str(e)}
+                    continue
+                updates.add(record_id, packing_lists_update(shipment_groups[record_id], download))
+                results[record_id] = {'download': download, 'reused': False}
+            errors = updates.flush()
+
+            for record_id in unattached + list(futures):
+                if record_id in errors:
+                    results[record_id] = {'error': 'Error uploading packaging list to Airtable: ' + errors[record_id]}
+                elif 'download' in results[record_id]:
+                    fingerprints[record_id]['download'] = results[record_id]['download']
+                    fingerprints[record_id]['attached'] = True
+                    executor.submit(put_packing_list_fingerprint, s3_client, record_id, fingerprints[record_id])
+
+        # hand the results to the callers waiting for the leases, in the form generate_packaging_list returns
+        for record_id, result in results.items():
+            if 'download' in result:
+                leases.finish(packing_list_lease_key(record_id, 'xlsx'), [result['download'], result['reused']])
+            else:
+                leases.finish(packing_list_lease_key(record_id, 'xlsx'), error=result['error'])
+
+        response = {
+            "message": "{} of {} packaging lists are generated and attached to the Airtable".format(
+                len([result for result in results.values() if 'download' in result]),
+                len(results)
+            ),
+            "results": [dict(recordId=record_id, **result) for record_id, result in results.items()]
+        }
+        if body.get('debug'):
+            response['debug'] = metrics.as_dict()
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps(response)
+        }
+    except Exception as e:
+        print(e)
+        return {
+            "statusCode": 500,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({
+                "error": "Error occured",
+                "message": str(e)
+            })
+        }
+    finally:
+        if leases:
+            leases.close()
+        metrics.emit('create_batch')
+
+
+def process_jobs(event, context):
+    # worker for async create requests. In Lambda the jobs arrive as SQS records in the event,
+    # when invoked without records (locally) it drains the configured job queue instead.
+    if event and 'Records' in event:
+        messages = [json.loads(record['body']) for record in event['Records']]
+    else:
+        messages = get_job_queue().receive()
+
+    store = get_job_store()
+    s3_client = aws_client('s3')
+    for message in messages:
+        print('##### Processing job ', message['jobId'], ' started #####')
+        metrics.reset()
+        try:
+            download, reused, coalesced = generate_packaging_list_coalesced(
+                s3_client,
+                message['recordId'],
+                job_progress(store, message['jobId']),
+                message.get('force', False),
+                message.get('format', 'xlsx'),
+                message.get('attach', True)
+            )
+            finish_job(store, message['jobId'], download=download, reused=reused)
+        except Exception as e:
+            print(e)
+            finish_job(store, message['jobId'], error=str(e))
+        metrics.emit('process_jobs', jobId=message['jobId'])
+        print('##### Processing job ', message['jobId'], ' finished #####')
+    return {'processed': len(messages)}
+
+
+def job_status(event, context):
+    job_id = (event.get('pathParameters') or {}).get('jobId')
+    job = get_job_store().get(job_id) if job_id else None
+    if job is None:
+        return {
+            "statusCode": 404,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps({
+                "error": "Error occured",
+                "message": "Job not found: {}".format(job_id)
+            })
+        }
+
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Access-Control-Allow-Origin": "*"
+        },
+        "body": json.dumps(job)
+    }
+
 
-        print('##### Putting generated packaging list to S3 started. Object name: ', object_name, ' #####')
-        s3_client.put_object(
-            Body = packaging_list,
-            Bucket = os.getenv('BUCKET_NAME'),
-            Key = object_name,
-            ACL ='public-read'
+# Pre-generation keeps packing lists current before anyone asks for them, so create only has to run the
+# precheck. Airtable notifies airtable_webhook of changes to the base, and poll_changes runs on a schedule
+# to catch up on missed notifications. Airtable's notifications carry no record data, so both look up the
+# records modified since the last poll and queue a job for every shipment group they affect: a group that
+# changed itself, or one whose packing list was built from a modified record.
+#   PREGENERATE_FORMATS      output formats kept current, comma separated
+#   PREGENERATE_WINDOW       seconds a packing list is kept current after it was last generated or checked
+#   AIRTABLE_WEBHOOK_SECRET  macSecretBase64 of the Airtable webhook, notifications are signed with it
+PREGENERATE_FORMATS = [output_format for output_format in os.getenv('PREGENERATE_FORMATS', 'xlsx').split(',') if output_format]
+PREGENERATE_WINDOW = float(os.getenv('PREGENERATE_WINDOW', 14 * 24 * 60 * 60))
+CHANGE_FEED_TABLES = ('ShipmentGroup',) + CHANGE_TRACKED_TABLES
+CHANGE_FEED_CURSOR_KEY = 'changes/cursor.json'
+# modified records read per table and poll, with more every watched packing list counts as affected
+CHANGE_FEED_MAX_RECORDS = 1000
+
+def watched_packing_lists(s3_client):
+    # (record id, output format, fingerprint) of every packing list in PREGENERATE_FORMATS that was
+    # generated or checked within PREGENERATE_WINDOW
+    watched = []
+    options = {'Bucket': os.getenv('BUCKET_NAME'), 'Prefix': FINGERPRINT_PREFIX}
+    while True:
+        response = s3_client.list_objects_v2(**options)
+        for item in response.get('Contents', []):
+            if item['LastModified'].timestamp() < time.time() - PREGENERATE_WINDOW:
+                continue
+            record_id, _, output_format = item['Key'][len(FINGERPRINT_PREFIX):-len('.json')].partition('.')
+            if (output_format or 'xlsx') in PREGENERATE_FORMATS:
+                watched.append((record_id, output_format or 'xlsx'))
+        if not response.get('IsTruncated'):
+            break
+        options['ContinuationToken'] = response['NextContinuationToken']
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+        fingerprints = list(executor.map(lambda item: get_packing_list_fingerprint(s3_client, *item), watched))
+    return [
+        (record_id, output_format, packing_list_fingerprint)
+        for (record_id, output_format), packing_list_fingerprint in zip(watched, fingerprints) if packing_list_fingerprint
+    ]
+
+def poll_changes_once(s3_client):
+    # queue a pre-generation job for every watched packing list affected by the records modified since the
+    # last poll. The first poll only starts the feed. A modified shipment group only counts when the fields
+    # the packing list is built from changed, attaching a packing list modifies it too.
+    polled = time.time()
+    try:
+        cursor = json.loads(s3_client.get_object(Bucket=os.getenv('BUCKET_NAME'), Key=CHANGE_FEED_CURSOR_KEY)['Body'].read())
+    except s3_client.exceptions.NoSuchKey:
+        cursor = None
+
+    modified = OrderedDict()
+    queued = []
+    if cursor:
+        with ThreadPoolExecutor(max_workers=AIRTABLE_MAX_WORKERS) as executor:
+            changes = [
+                (table_name, request_modified_records(
+                    executor,
+                    airtable_table(os.getenv('AIRTABLE_APP_ID'), table_name, os.getenv('AIRTABLE_SECRET_KEY')),
+                    cursor['polled'],
+                    CHANGE_FEED_MAX_RECORDS,
+                    AIRTABLE_FIELDS[table_name][:2] if table_name == 'ShipmentGroup' else None
+                )) for table_name in CHANGE_FEED_TABLES
+            ]
+            changes = OrderedDict((table_name, change.result()) for table_name, change in changes)
+        modified = OrderedDict((table_name, [record['id'] for record in records]) for table_name, records in changes.items())
+        truncated = any(len(record_ids) >= CHANGE_FEED_MAX_RECORDS for record_ids in modified.values())
+        shipment_group_fingerprints = dict(
+            (record['id'], fingerprint_shipment_group(record['fields'].get('DomesticShipments', []), field(record, 'Cosignee Name')))
+            for record in changes['ShipmentGroup']
         )
-        print('##### Putting generated packaging list to S3 finished #####')
-        
-        upload_packaging_list_to_airtable(
-            os.getenv('AIRTABLE_APP_ID'),
-            os.getenv('AIRTABLE_SECRET_KEY'),
-            body['recordId'],
-            "https://{}.s3.amazonaws.com/{}".format(os.getenv('BUCKET_NAME'), object_name)
+        # a packing list lists its own shipment group among its records, that one is compared by fingerprint
+        modified_ids = set(
+            record_id for table_name, record_ids in modified.items() if table_name != 'ShipmentGroup' for record_id in record_ids
         )
 
+        affected = []
+        if truncated or modified_ids or shipment_group_fingerprints:
+            for record_id, output_format, packing_list_fingerprint in watched_packing_lists(s3_client):
+                # fingerprints written before they listed their records count as affected by any change
+                record_ids = packing_list_fingerprint.get('records')
+                if (
+                    truncated or record_ids is None or modified_ids.intersection(record_ids) or
+                    shipment_group_fingerprints.get(record_id, packing_list_fingerprint.get('shipmentGroup')) !=
+                    packing_list_fingerprint.get('shipmentGroup')
+                ):
+                    affected.append((record_id, output_format))
+
+        queue, store = get_job_queue(), get_job_store()
+        for record_id, output_format in affected:
+            # pre-generated packing lists are attached by the next create that reuses them
+            job = submit_job(queue, store, record_id, output_format=output_format, attach=False)
+            queued.append({'recordId': record_id, 'format': output_format, 'jobId': job['jobId']})
+
+    # only advanced once the jobs are queued, a failed poll is repeated by the next one
+    s3_client.put_object(
+        Body=json.dumps({'polled': polled}).encode('utf-8'),
+        Bucket=os.getenv('BUCKET_NAME'),
+        Key=CHANGE_FEED_CURSOR_KEY,
+        ContentType='application/json'
+    )
+    modified_records = sum(len(record_ids) for record_ids in modified.values())
+    metrics.increment('modified_records', modified_records)
+    metrics.increment('pregeneration_jobs', len(queued))
+    print('##### Change feed: {} modified records, {} pre-generation jobs queued #####'.format(modified_records, len(queued)))
+    return {'modifiedRecords': modified_records, 'queued': queued}
+
+def poll_changes_coalesced(s3_client, notified=0):
+    # concurrent polls share one. A caller that learned about a change at notified only joins a poll that
+    # started after it, an earlier one could miss the change. Returns the poll result and whether it was joined.
+    return single_flight(
+        get_lease_store(),
+        'change-feed',
+        lambda: poll_changes_once(s3_client),
+        data={'started': time.time()},
+        join=lambda data: data['started'] >= notified
+    )
+
+def poll_changes(event, context):
+    # scheduled catch-up poll of the change feed
+    metrics.reset()
+    try:
+        with metrics.timer('poll'):
+            result, joined = poll_changes_coalesced(aws_client('s3'))
+        result['joined'] = joined
+        return result
+    finally:
+        metrics.emit('poll_changes')
+
+def verify_webhook_signature(body, signature):
+    # Airtable signs every notification with an HMAC-SHA256 of its body, keyed with the webhook's macSecretBase64
+    secret = os.getenv('AIRTABLE_WEBHOOK_SECRET')
+    if not secret or not signature:
+        return False
+    expected = 'hmac-sha256=' + hmac.new(base64.b64decode(secret), body.encode('utf-8'), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def airtable_webhook(event, context):
+    notified = time.time()
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+
+    if not verify_webhook_signature(body, headers.get('x-airtable-content-mac')):
         return {
-            "statusCode": 200,
+            "statusCode": 401,
             "headers": {
                 "Access-Control-Allow-Origin": "*"
             },
             "body": json.dumps({
-                "message": "A new packaging list is generated and attached to the Airtable",
-                "download": "https://{}.s3.amazonaws.com/{}".format(os.getenv('BUCKET_NAME'), object_name)
+                "error": "Error occured",
+                "message": "Invalid webhook signature"
             })
         }
+
+    metrics.reset()
+    try:
+        notification = json.loads(body)
+        if notification.get('base', {}).get('id') != os.getenv('AIRTABLE_APP_ID'):
+            response = {'message': 'Notification for another base ignored'}
+        else:
+            with metrics.timer('poll'):
+                response, joined = poll_changes_coalesced(aws_client('s3'), notified)
+            response['joined'] = joined
+        return {
+            "statusCode": 200,
+            "headers": {
+                "Access-Control-Allow-Origin": "*"
+            },
+            "body": json.dumps(response)
+        }
     except Exception as e:
         print(e)
         return {
@@ -499,3 +2256,22 @@ def create(event, context):
                 "message": str(e)
             })
         }
+    finally:
+        metrics.emit('airtable_webhook')
+
+
+def prewarm():
+    # import the heavy modules and create the clients now instead of on the first request. Pays off where the
+    # init phase is not on the request path, e.g. with provisioned concurrency.
+    import multiprocessing
+    import xlsxwriter
+
+    aws_client('s3')
+    if os.getenv('AIRTABLE_APP_ID') and os.getenv('AIRTABLE_SECRET_KEY'):
+        for table_name in AIRTABLE_FIELDS:
+            airtable_table(os.getenv('AIRTABLE_APP_ID'), table_name, os.getenv('AIRTABLE_SECRET_KEY'))
+    if not reference_cache.loaded:
+        reference_cache.load()
+
+if os.getenv('PREWARM', '').lower() == 'true':
+    prewarm()
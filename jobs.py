@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from collections import deque
+from contextlib import closing
+from datetime import datetime
+
+from clients import aws_client
+
+# Asynchronous packing list generation: create() enqueues a job and returns its id, a worker
+# function takes it off the queue and generates the packing list, and the job state store
+# tracks the progress of every job for the status endpoint.
+#
+# Both the queue and the store are pluggable so the whole flow can run locally:
+#   JOB_QUEUE=sqs|sqlite|memory, JOB_QUEUE_URL for sqs, JOB_QUEUE_PATH for sqlite
+#   JOB_STORE=s3|sqlite|memory, JOB_STORE_BUCKET for s3, JOB_STORE_PATH for sqlite
+
+JOB_STORE_PREFIX = 'jobs/'
+
+def now():
+    return datetime.utcnow().isoformat() + 'Z'
+
+
+class MemoryJobQueue(object):
+    def __init__(self):
+        self.messages = deque()
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.messages.append(json.dumps(message))
+
+    def receive(self, max_messages=10):
+        with self.lock:
+            messages = []
+            while self.messages and len(messages) < max_messages:
+                messages.append(json.loads(self.messages.popleft()))
+            return messages
+
+
+class SQLiteJobQueue(object):
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def send(self, message):
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT INTO queue (message) VALUES (?)', (json.dumps(message),))
+
+    def receive(self, max_messages=10):
+        # take messages off the queue in one transaction, so concurrent workers never get the same job
+        with closing(self.connect()) as connection, connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute('SELECT id, message FROM queue ORDER BY id LIMIT ?', (max_messages,)).fetchall()
+            connection.executemany('DELETE FROM queue WHERE id = ?', [(row[0],) for row in rows])
+        return [json.loads(row[1]) for row in rows]
+
+
+class SQSJobQueue(object):
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs_client = aws_client('sqs')
+
+    def send(self, message):
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def receive(self, max_messages=10):
+        # only needed when polling by hand, in Lambda the messages arrive in the worker's event
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_messages, 10))
+        messages = []
+        for message in response.get('Messages', []):
+            self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+            messages.append(json.loads(message['Body']))
+        return messages
+
+
+class MemoryJobStore(object):
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def put(self, job):
+        with self.lock:
+            self.jobs[job['jobId']] = json.dumps(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return json.loads(job) if job else None
+
+
+class SQLiteJobStore(object):
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, job TEXT NOT NULL)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def put(self, job):
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO jobs (job_id, job) VALUES (?, ?)', (job['jobId'], json.dumps(job)))
+
+    def get(self, job_id):
+        with closing(self.connect()) as connection, connection:
+            row = connection.execute('SELECT job FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class S3JobStore(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.s3_client = aws_client('s3')
+
+    def put(self, job):
+        self.s3_client.put_object(
+            Body=json.dumps(job).encode('utf-8'),
+            Bucket=self.bucket,
+            Key=JOB_STORE_PREFIX + job['jobId'] + '.json',
+            ContentType='application/json'
+        )
+
+    def get(self, job_id):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=JOB_STORE_PREFIX + job_id + '.json')
+        except self.s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+
+# the in-memory backends only make sense within one process, keep a single instance of each
+memory_job_queue = MemoryJobQueue()
+memory_job_store = MemoryJobStore()
+
+def get_job_queue():
+    backend = os.getenv('JOB_QUEUE', 'memory')
+    if backend == 'sqs':
+        return SQSJobQueue(os.getenv('JOB_QUEUE_URL'))
+    if backend == 'sqlite':
+        return SQLiteJobQueue(os.getenv('JOB_QUEUE_PATH', '/tmp/jobs.sqlite3'))
+    if backend == 'memory':
+        return memory_job_queue
+    raise ValueError('Unknown job queue: ' + backend)
+
+def get_job_store():
+    backend = os.getenv('JOB_STORE', 'memory')
+    if backend == 's3':
+        return S3JobStore(os.getenv('JOB_STORE_BUCKET', os.getenv('BUCKET_NAME')))
+    if backend == 'sqlite':
+        return SQLiteJobStore(os.getenv('JOB_STORE_PATH', '/tmp/jobs.sqlite3'))
+    if backend == 'memory':
+        return memory_job_store
+    raise ValueError('Unknown job store: ' + backend)
+
+
+def submit_job(queue, store, record_id, force=False, output_format='xlsx', attach=True):
+    # attach=False leaves the generated packing list off the shipment group, see generate_packaging_list
+    job = {
+        'jobId': uuid.uuid4().hex,
+        'recordId': record_id,
+        'force': force,
+        'format': output_format,
+        'status': 'queued',
+        'stage': None,
+        'stages': {},
+        'download': None,
+        'reused': None,
+        'error': None,
+        'created': now(),
+        'updated': now()
+    }
+    store.put(job)
+    queue.send({'jobId': job['jobId'], 'recordId': record_id, 'force': force, 'format': output_format, 'attach': attach})
+    return job
+
+def job_progress(store, job_id):
+    # returns a callback that marks the given stage as started and the previous one as finished
+    def progress(stage):
+        job = store.get(job_id)
+        timestamp = now()
+        if job['stage']:
+            job['stages'][job['stage']]['finished'] = timestamp
+        job['stages'][stage] = {'started': timestamp, 'finished': None}
+        job['stage'] = stage
+        job['status'] = 'running'
+        job['updated'] = timestamp
+        store.put(job)
+    return progress
+
+def finish_job(store, job_id, download=None, reused=None, error=None):
+    job = store.get(job_id)
+    timestamp = now()
+    if job['stage']:
+        job['stages'][job['stage']]['finished'] = timestamp
+    job['status'] = 'failed' if error else 'succeeded'
+    job['download'] = download
+    job['reused'] = reused
+    job['error'] = error
+    job['updated'] = timestamp
+    store.put(job)
+    return job
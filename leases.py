@@ -0,0 +1,274 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from clients import aws_client
+
+# Single-flight coalescing: of all concurrent callers asking for the same key, one takes a lease and
+# does the work while the others wait for its result instead of repeating it. The lease is renewed
+# while the work runs, so callers take over when its holder dies, and kept with the result once the
+# work is done, so callers that were waiting can pick that up.
+#
+# The lease store is pluggable like the job queue and store:
+#   LEASE_STORE=dynamodb|sqlite|memory, LEASE_TABLE for dynamodb, LEASE_STORE_PATH for sqlite
+
+LEASE_TTL = float(os.getenv('LEASE_TTL', 30))
+LEASE_WAIT_TIMEOUT = float(os.getenv('LEASE_WAIT_TIMEOUT', 300))
+LEASE_POLL_INTERVAL = 0.25
+# finished leases are kept this long for callers that are still waiting
+LEASE_RESULT_TTL = 300
+
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class MemoryLeaseStore(object):
+    def __init__(self):
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, owner, ttl, data=None):
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease and lease['state'] == RUNNING and lease['expires'] > time.time():
+                return False
+            self.leases[key] = {'owner': owner, 'state': RUNNING, 'expires': time.time() + ttl, 'data': data, 'result': None}
+            return True
+
+    def update(self, key, owner, ttl, state=RUNNING, result=None):
+        # renews or finishes the lease, if owner still holds it
+        with self.lock:
+            lease = self.leases.get(key)
+            if not lease or lease['owner'] != owner:
+                return False
+            lease.update(state=state, expires=time.time() + ttl, result=result)
+            return True
+
+    def get(self, key):
+        with self.lock:
+            lease = self.leases.get(key)
+            return dict(lease) if lease else None
+
+
+class SQLiteLeaseStore(object):
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'lease_key TEXT PRIMARY KEY, owner TEXT NOT NULL, state TEXT NOT NULL, expires REAL NOT NULL, data TEXT, result TEXT)'
+            )
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def acquire(self, key, owner, ttl, data=None):
+        with closing(self.connect()) as connection, connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT state, expires FROM leases WHERE lease_key = ?', (key,)).fetchone()
+            if row and row[0] == RUNNING and row[1] > time.time():
+                return False
+            connection.execute(
+                'INSERT OR REPLACE INTO leases (lease_key, owner, state, expires, data, result) VALUES (?, ?, ?, ?, ?, NULL)',
+                (key, owner, RUNNING, time.time() + ttl, json.dumps(data))
+            )
+            return True
+
+    def update(self, key, owner, ttl, state=RUNNING, result=None):
+        with closing(self.connect()) as connection, connection:
+            cursor = connection.execute(
+                'UPDATE leases SET state = ?, expires = ?, result = ? WHERE lease_key = ? AND owner = ?',
+                (state, time.time() + ttl, json.dumps(result), key, owner)
+            )
+            return cursor.rowcount == 1
+
+    def get(self, key):
+        with closing(self.connect()) as connection, connection:
+            row = connection.execute('SELECT owner, state, expires, data, result FROM leases WHERE lease_key = ?', (key,)).fetchone()
+        if not row:
+            return None
+        return {
+            'owner': row[0],
+            'state': row[1],
+            'expires': row[2],
+            'data': json.loads(row[3]) if row[3] else None,
+            'result': json.loads(row[4]) if row[4] else None
+        }
+
+
+class DynamoDBLeaseStore(object):
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.dynamodb_client = aws_client('dynamodb')
+
+    def acquire(self, key, owner, ttl, data=None):
+        now = time.time()
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'leaseKey': {'S': key},
+                    'owner': {'S': owner},
+                    'state': {'S': RUNNING},
+                    'expires': {'N': str(now + ttl)},
+                    'data': {'S': json.dumps(data)},
+                    # DynamoDB TTL attribute, drops old leases eventually
+                    'expiresAt': {'N': str(int(now + ttl + LEASE_RESULT_TTL))}
+                },
+                ConditionExpression='attribute_not_exists(leaseKey) OR #state <> :running OR expires < :now',
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={':running': {'S': RUNNING}, ':now': {'N': str(now)}}
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def update(self, key, owner, ttl, state=RUNNING, result=None):
+        now = time.time()
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key={'leaseKey': {'S': key}},
+                UpdateExpression='SET #state = :state, expires = :expires, expiresAt = :expires_at, #result = :result',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#state': 'state', '#result': 'result', '#owner': 'owner'},
+                ExpressionAttributeValues={
+                    ':state': {'S': state},
+                    ':expires': {'N': str(now + ttl)},
+                    ':expires_at': {'N': str(int(now + ttl + LEASE_RESULT_TTL))},
+                    ':result': {'S': json.dumps(result)},
+                    ':owner': {'S': owner}
+                }
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def get(self, key):
+        item = self.dynamodb_client.get_item(TableName=self.table_name, Key={'leaseKey': {'S': key}}, ConsistentRead=True).get('Item')
+        if not item:
+            return None
+        return {
+            'owner': item['owner']['S'],
+            'state': item['state']['S'],
+            'expires': float(item['expires']['N']),
+            'data': json.loads(item['data']['S']),
+            'result': json.loads(item['result']['S']) if 'result' in item else None
+        }
+
+
+# the in-memory backend only coalesces callers within one process, keep a single instance
+memory_lease_store = MemoryLeaseStore()
+
+def get_lease_store():
+    backend = os.getenv('LEASE_STORE', 'memory')
+    if backend == 'dynamodb':
+        return DynamoDBLeaseStore(os.getenv('LEASE_TABLE'))
+    if backend == 'sqlite':
+        return SQLiteLeaseStore(os.getenv('LEASE_STORE_PATH', '/tmp/leases.sqlite3'))
+    if backend == 'memory':
+        return memory_lease_store
+    raise ValueError('Unknown lease store: ' + backend)
+
+
+def single_flight(store, key, func, data=None, join=None, ttl=LEASE_TTL, wait_timeout=LEASE_WAIT_TIMEOUT):
+    """Call func() unless a concurrent caller is already doing it for key, and share its result.
+
+    data is stored with the lease, join(data) decides whether the running call can be joined, otherwise
+    the caller waits for it to finish and then runs its own. Returns (result, joined), where joined tells
+    whether the result came from another caller. The result must be JSON serializable, a failure of
+    the joined call is raised as ValueError.
+    """
+    owner = uuid.uuid4().hex
+    deadline = time.time() + wait_timeout
+    awaited = None
+    while True:
+        lease = store.get(key)
+        if lease and lease['owner'] == awaited and lease['state'] != RUNNING:
+            if lease['state'] == FAILED:
+                raise ValueError(lease['result'])
+            return lease['result'], True
+
+        if not lease or lease['state'] != RUNNING or lease['expires'] <= time.time():
+            if store.acquire(key, owner, ttl, data):
+                return run_leased(store, key, owner, func, ttl), False
+            continue
+
+        # join the running call, or a later one when its holder died or it can't be joined
+        if lease['owner'] != awaited:
+            awaited = lease['owner'] if join is None or join(lease['data']) else None
+
+        if time.time() > deadline:
+            raise ValueError('Timed out waiting for a concurrent request for ' + key)
+        time.sleep(LEASE_POLL_INTERVAL)
+
+
+def run_leased(store, key, owner, func, ttl):
+    # run func while renewing the lease in the background, then store its result on the lease
+    finished = threading.Event()
+
+    def renew():
+        while not finished.wait(ttl / 3):
+            store.update(key, owner, ttl)
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        result = func()
+    except Exception as e:
+        finished.set()
+        renewer.join()
+        store.update(key, owner, LEASE_RESULT_TTL, FAILED, str(e))
+        raise
+    finished.set()
+    renewer.join()
+    store.update(key, owner, LEASE_RESULT_TTL, SUCCEEDED, result)
+    return result
+
+
+class BatchLeases(object):
+    """Leases on several keys for a caller that does the work for all of them at once.
+
+    The counterpart of single_flight for batches: keys whose lease another caller holds are left out of
+    acquired, the others are renewed in the background until finish() stores their result, so concurrent
+    single_flight callers wait for and join them. close() fails the leases that were never finished.
+    """
+
+    def __init__(self, store, keys, data=None, ttl=LEASE_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.owner = uuid.uuid4().hex
+        self.acquired = [key for key in keys if store.acquire(key, self.owner, ttl, data)]
+        self.running = set(self.acquired)
+        # renewals and results are written under the lock, so a renewal can't reopen a finished lease
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.renewer = threading.Thread(target=self.renew, daemon=True)
+        self.renewer.start()
+
+    def renew(self):
+        while not self.finished.wait(self.ttl / 3):
+            with self.lock:
+                for key in self.running:
+                    self.store.update(key, self.owner, self.ttl)
+
+    def finish(self, key, result=None, error=None):
+        with self.lock:
+            if key not in self.running:
+                return
+            self.running.discard(key)
+            if error is None:
+                self.store.update(key, self.owner, LEASE_RESULT_TTL, SUCCEEDED, result)
+            else:
+                self.store.update(key, self.owner, LEASE_RESULT_TTL, FAILED, error)
+
+    def close(self, error='The batch stopped before it was done'):
+        for key in list(self.running):
+            self.finish(key, error=error)
+        self.finished.set()
+        self.renewer.join()
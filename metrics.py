@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Per invocation instrumentation of the create pipeline. Everything is collected on the module level
+# metrics object (a Lambda container serves one invocation at a time), written to the log as one
+# CloudWatch embedded metric format (METRICS_FORMAT=emf) or plain JSON (METRICS_FORMAT=json) line,
+# and can be returned in the debug section of a response.
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'airtable-packaging')
+METRICS_FORMAT = os.getenv('METRICS_FORMAT', 'emf')
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# units of the values that are published as CloudWatch metrics, everything else is only logged
+METRIC_UNITS = {
+    'airtable_requests': 'Count',
+    'airtable_retries': 'Count',
+    'airtable_bytes': 'Bytes',
+    'rows_written': 'Count',
+    'cells_written': 'Count',
+    'workbook_bytes': 'Bytes',
+    'export_bytes': 'Bytes'
+}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.timings = OrderedDict()
+            self.counters = OrderedDict()
+            self.histograms = OrderedDict()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_timing(name, (time.monotonic() - start) * 1000)
+
+    def add_timing(self, name, milliseconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0) + milliseconds
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        # bucketed histogram, the bucket key is the upper bound of the bucket
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'count': 0,
+                    'sum': 0,
+                    'max': 0,
+                    'buckets': OrderedDict([(str(bound), 0) for bound in LATENCY_BUCKETS] + [('inf', 0)])
+                }
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['max'] = max(histogram['max'], value)
+            for bound in LATENCY_BUCKETS:
+                if value <= bound:
+                    histogram['buckets'][str(bound)] += 1
+                    break
+            else:
+                histogram['buckets']['inf'] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'timings_ms': OrderedDict((name, round(value, 1)) for name, value in self.timings.items()),
+                'counters': OrderedDict((name, round(value, 1) if isinstance(value, float) else value) for name, value in self.counters.items()),
+                'histograms': json.loads(json.dumps(self.histograms))
+            }
+
+    def emit(self, operation, **properties):
+        data = self.as_dict()
+        if METRICS_FORMAT == 'emf':
+            line = OrderedDict()
+            line['_aws'] = {
+                'Timestamp': int(self.started * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Operation']],
+                    'Metrics': [{'Name': name + '_ms', 'Unit': 'Milliseconds'} for name in data['timings_ms']] +
+                        [{'Name': name, 'Unit': METRIC_UNITS[name]} for name in data['counters'] if name in METRIC_UNITS]
+                }]
+            }
+            line['Operation'] = operation
+            line.update((name + '_ms', value) for name, value in data['timings_ms'].items())
+            line.update(data['counters'])
+            line['histograms'] = data['histograms']
+        else:
+            line = OrderedDict([('operation', operation)])
+            line.update(data)
+        line.update(properties)
+        print(json.dumps(line))
+
+
+metrics = Metrics()
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+
+# Compact model of the records a packing list is built from. Airtable records are normalized once
+# when a shipment group is resolved: linked records are looked up, single value lists unwrapped and
+# missing fields replaced by their defaults, so rendering only reads plain attributes.
+
+
+def field(record, name, default=''):
+    # the value of a field, the first element for linked records and lookups, default when empty
+    value = record['fields'].get(name, default)
+    if isinstance(value, list):
+        return value[0] if value else default
+    return value
+
+
+class Model(object):
+    __slots__ = ()
+    # the attributes read from Airtable, the others are computed while rendering
+    data_fields = ()
+
+    def as_dict(self):
+        data = OrderedDict()
+        for name in self.data_fields:
+            value = getattr(self, name)
+            if isinstance(value, Model):
+                value = value.as_dict()
+            elif isinstance(value, list):
+                value = [item.as_dict() if isinstance(item, Model) else item for item in value]
+            data[name] = value
+        return data
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.data_fields))
+
+
+class Sku(Model):
+    __slots__ = data_fields = ('id', 'sku', 'fnsku')
+
+    def __init__(self, id=None, sku='', fnsku=''):
+        self.id = id
+        self.sku = sku
+        self.fnsku = fnsku
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['id'], field(record, 'SKU'), field(record, 'FNSKU'))
+
+
+class PackagingProfile(Model):
+    __slots__ = data_fields = ('id', 'units_per_carton', 'length_cm', 'width_cm', 'height_cm', 'weight_kg')
+
+    def __init__(self, id=None, units_per_carton='', length_cm='', width_cm='', height_cm='', weight_kg=''):
+        self.id = id
+        self.units_per_carton = units_per_carton
+        self.length_cm = length_cm
+        self.width_cm = width_cm
+        self.height_cm = height_cm
+        self.weight_kg = weight_kg
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record['id'],
+            field(record, 'UnitsPerCarton'),
+            field(record, 'CartonLengthCM'),
+            field(record, 'CartonWidthCM'),
+            field(record, 'CartonHeightCM'),
+            field(record, 'CartonWeightKG')
+        )
+
+
+class FulfillmentCenter(Model):
+    __slots__ = data_fields = ('id', 'fcid', 'address', 'country')
+
+    def __init__(self, id=None, fcid='', address='', country=''):
+        self.id = id
+        self.fcid = fcid
+        self.address = address
+        self.country = country
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['id'], field(record, 'FCID'), field(record, 'FCAddress'), field(record, 'FacilityCountry'))
+
+
+class LineItem(Model):
+    data_fields = ('id', 'sku', 'packaging_profile', 'case_qty', 'ship_quantity', 'box_mark')
+    __slots__ = data_fields + ('carton_cbm', 'kg', 'cbm')
+
+    def __init__(self, id, sku, packaging_profile, case_qty='', ship_quantity='', box_mark=''):
+        self.id = id
+        self.sku = sku
+        self.packaging_profile = packaging_profile
+        self.case_qty = case_qty
+        self.ship_quantity = ship_quantity
+        self.box_mark = box_mark
+        self.carton_cbm = 0
+        self.kg = 0
+        self.cbm = 0
+
+    @classmethod
+    def from_record(cls, record, sku, packaging_profile):
+        return cls(record['id'], sku, packaging_profile, field(record, 'CaseQty'), field(record, 'ShipQuantity'), field(record, 'BoxMark'))
+
+
+class DomesticShipment(Model):
+    data_fields = ('id', 'fulfillment_center', 'fba_shipment_id', 'amz_reference_id', 'line_items')
+    __slots__ = data_fields + ('domestic_shipment_line', 'total_line', 'domestic_shipment_line_start', 'domestic_shipment_line_end', 'totals')
+
+    def __init__(self, id, fulfillment_center=None, fba_shipment_id='', amz_reference_id='', line_items=None):
+        self.id = id
+        self.fulfillment_center = fulfillment_center or FulfillmentCenter()
+        self.fba_shipment_id = fba_shipment_id
+        self.amz_reference_id = amz_reference_id
+        self.line_items = line_items or []
+        self.domestic_shipment_line = None
+        self.total_line = None
+        self.domestic_shipment_line_start = None
+        self.domestic_shipment_line_end = None
+        self.totals = None
+
+    @classmethod
+    def from_record(cls, record, fulfillment_center, line_items):
+        return cls(record['id'], fulfillment_center, field(record, 'FBA Shipment ID'), field(record, 'AMZReferenceID'), line_items)
+
+
+class ShipmentGroup(Model):
+    data_fields = ('id', 'cosignee', 'domestic_shipments')
+    # the attachments of PackingLists Generated, kept for the write-back but not part of the packing list,
+    # and when the oldest record of the group served from a cache was fetched, None if none was
+    __slots__ = data_fields + ('packing_lists', 'fetched')
+
+    def __init__(self, id, cosignee='', domestic_shipments=None, packing_lists=None):
+        self.id = id
+        self.cosignee = cosignee
+        self.domestic_shipments = domestic_shipments or []
+        self.packing_lists = packing_lists or []
+        self.fetched = None
+
+    @classmethod
+    def from_record(cls, record, domestic_shipments):
+        return cls(record['id'], field(record, 'Cosignee Name'), domestic_shipments, record['fields'].get('PackingLists Generated'))
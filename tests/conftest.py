@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
+
+# the handler reads its settings while it is imported
+os.environ.update(
+    AIRTABLE_APP_ID='appTest',
+    AIRTABLE_SECRET_KEY='keyTest',
+    BUCKET_NAME='test-packing-lists',
+    CLOCK_SKEW_MARGIN='1',
+    JOB_QUEUE='memory',
+    JOB_STORE='memory',
+    LEASE_STORE='memory'
+)
+os.environ.pop('REFERENCE_CACHE_PATH', None)
+
+from fake_airtable import FakeAirtable
+from fake_s3 import FakeS3Client
+
+
+@pytest.fixture(scope='session')
+def fake_airtable_server():
+    import airtable
+
+    fake = FakeAirtable(latency=0, rate_limit=0).start()
+    # the tables of handler keep the url they were created with, so every test shares one server
+    airtable.Airtable.API_URL = fake.url
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fake_airtable(fake_airtable_server, monkeypatch):
+    import handler
+
+    # the fake has no rate limit, don't pace the requests to it either
+    monkeypatch.setattr(handler, 'airtable_rate_limiter', handler.RateLimiter(1000))
+    handler.reference_cache.invalidate()
+    handler.metrics.reset()
+    fake_airtable_server.load({})
+    fake_airtable_server.reset_counters()
+    yield fake_airtable_server
+    handler.reference_cache.invalidate()
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    import clients
+
+    s3_client = FakeS3Client()
+    monkeypatch.setitem(clients.aws_clients, 's3', s3_client)
+    return s3_client
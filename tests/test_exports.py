@@ -0,0 +1,19 @@
+import json
+
+import exports
+import handler
+from fake_airtable import build_shipment_group
+
+GROUP_ID = 'recShipmentGroup'
+
+
+def test_parquet_without_pyarrow_fails_before_fetching(fake_airtable, s3_client, monkeypatch):
+    fake_airtable.load(build_shipment_group(2, 2))
+    monkeypatch.setattr(exports, 'find_spec', lambda name: None)
+
+    for body in ({'recordId': GROUP_ID, 'format': 'parquet'}, {'recordId': GROUP_ID, 'format': 'parquet', 'async': True}):
+        response = handler.create({'body': json.dumps(body)}, None)
+        assert response['statusCode'] == 500
+        assert json.loads(response['body'])['message'] == exports.PARQUET_UNAVAILABLE
+    assert not fake_airtable.requests
+    assert not s3_client.objects
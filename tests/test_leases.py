@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+
+import pytest
+
+import leases
+from leases import BatchLeases, MemoryLeaseStore, SQLiteLeaseStore, single_flight
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteLeaseStore(str(tmp_path / 'leases.sqlite3'))
+    return MemoryLeaseStore()
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(leases, 'LEASE_POLL_INTERVAL', 0.01)
+
+
+def run_concurrently(funcs):
+    # start every func in its own thread at the same time, returns their results or exceptions in order
+    results = [None] * len(funcs)
+    barrier = threading.Barrier(len(funcs))
+
+    def run(index, func):
+        barrier.wait()
+        try:
+            results[index] = func()
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(index, func)) for index, func in enumerate(funcs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_callers_share_one_call(store):
+    calls = []
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'value': 42}
+
+    results = run_concurrently([lambda: single_flight(store, 'key', work) for i in range(5)])
+    assert len(calls) == 1
+    assert [result for result, joined in results] == [{'value': 42}] * 5
+    assert sorted(joined for result, joined in results) == [False, True, True, True, True]
+
+
+def test_failure_is_raised_to_joined_callers(store):
+    def work():
+        time.sleep(0.2)
+        raise ValueError('boom')
+
+    results = run_concurrently([lambda: single_flight(store, 'key', work) for i in range(3)])
+    assert all(isinstance(result, ValueError) and 'boom' in str(result) for result in results)
+
+
+def test_caller_that_cant_join_runs_after_the_running_call(store):
+    calls = []
+
+    def work(name):
+        calls.append(name)
+        time.sleep(0.2)
+        return name
+
+    first = threading.Thread(target=single_flight, args=(store, 'key', lambda: work('first')), kwargs={'data': {'force': False}})
+    first.start()
+    time.sleep(0.05)
+    result, joined = single_flight(store, 'key', lambda: work('second'), data={'force': True}, join=lambda data: data['force'])
+    first.join()
+    assert (result, joined) == ('second', False)
+    assert calls == ['first', 'second']
+
+
+def test_expired_lease_is_taken_over(store):
+    # a holder that died leaves a running lease behind that is never renewed
+    store.acquire('key', 'dead', 0.1, None)
+    result, joined = single_flight(store, 'key', lambda: 'done', wait_timeout=5)
+    assert (result, joined) == ('done', False)
+
+
+def test_batch_leases_skip_held_keys_and_hand_results_to_waiting_callers(store):
+    store.acquire('held', 'other', 30, None)
+    batch = BatchLeases(store, ['held', 'free'], data={'force': False})
+    assert batch.acquired == ['free']
+
+    def finish():
+        time.sleep(0.2)
+        batch.finish('free', ['download', False])
+
+    threading.Thread(target=finish).start()
+    result, joined = single_flight(store, 'free', lambda: pytest.fail('the batch is generating it'))
+    batch.close()
+    assert (result, joined) == (['download', False], True)
+
+
+def test_batch_leases_fail_unfinished_keys_on_close(store):
+    batch = BatchLeases(store, ['key'])
+    batch.close()
+    lease = store.get('key')
+    assert lease['state'] == leases.FAILED
+
+
+def test_create_batch_skips_groups_being_generated(fake_airtable, s3_client):
+    import handler
+    from fake_airtable import build_shipment_group
+
+    fake_airtable.load(build_shipment_group(1, 2, record_id='recGroup'))
+    store = handler.get_lease_store()
+    assert store.acquire(handler.packing_list_lease_key('recGroup', 'xlsx'), 'other', 30, {'force': False})
+    try:
+        response = handler.create_batch({'body': json.dumps({'recordIds': ['recGroup']})}, None)
+    finally:
+        store.update(handler.packing_list_lease_key('recGroup', 'xlsx'), 'other', 1, leases.FAILED, 'released')
+    body = json.loads(response['body'])
+    assert body['results'] == [{'recordId': 'recGroup', 'error': 'The packaging list is already being generated'}]
+    assert fake_airtable.requests['PATCH ShipmentGroup'] == 0
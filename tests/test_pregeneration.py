@@ -0,0 +1,84 @@
+import json
+import time
+
+import handler
+from jobs import get_job_queue
+from test_reference_cache import shipment_groups
+
+
+def create(record_id):
+    response = handler.create({'body': json.dumps({'recordId': record_id})}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+
+def attachments(fake_airtable, record_id):
+    return len(fake_airtable.records['ShipmentGroup'][record_id]['fields']['PackingLists Generated'])
+
+
+def test_pregenerated_packing_lists_are_attached_by_create(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA'), modified=time.time() - 3600)
+    get_job_queue().receive()
+
+    create('recGroupA')
+    assert attachments(fake_airtable, 'recGroupA') == 1
+    handler.poll_changes_once(s3_client)
+    # attaching the packing list modified the shipment group, but none of the fields it is built from
+    assert handler.poll_changes_once(s3_client)['queued'] == []
+
+    fake_airtable.update('DomesticShipmentLineItem', 'recGroupALineItem', {'ShipQuantity': 30})
+    # past the clock skew margin, so the next poll is the last one to see the edit
+    time.sleep(2.5)
+    queued = handler.poll_changes_once(s3_client)['queued']
+    assert [job['recordId'] for job in queued] == ['recGroupA']
+    handler.process_jobs({}, None)
+    assert attachments(fake_airtable, 'recGroupA') == 1
+    assert handler.get_packing_list_fingerprint(s3_client, 'recGroupA')['attached'] is False
+    assert handler.poll_changes_once(s3_client)['queued'] == []
+
+    result = create('recGroupA')
+    assert result['reused']
+    assert attachments(fake_airtable, 'recGroupA') == 2
+    assert handler.get_packing_list_fingerprint(s3_client, 'recGroupA')['attached'] is True
+    assert create('recGroupA')['reused']
+    assert attachments(fake_airtable, 'recGroupA') == 2
+    assert handler.poll_changes_once(s3_client)['queued'] == []
+
+
+def test_shipment_group_changes_are_pregenerated(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA'), modified=time.time() - 3600)
+    get_job_queue().receive()
+
+    create('recGroupA')
+    handler.poll_changes_once(s3_client)
+    fake_airtable.update('ShipmentGroup', 'recGroupA', {'Cosignee Name': 'ACME Two'})
+    queued = handler.poll_changes_once(s3_client)['queued']
+    assert [job['recordId'] for job in queued] == ['recGroupA']
+
+
+def test_batch_attaches_pregenerated_packing_lists(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA', 'recGroupB'), modified=time.time() - 3600)
+
+    handler.generate_packaging_list(s3_client, 'recGroupA', attach=False)
+    assert attachments(fake_airtable, 'recGroupA') == 0
+    response = handler.create_batch({'body': json.dumps({'recordIds': ['recGroupA', 'recGroupB']})}, None)
+    results = json.loads(response['body'])['results']
+    assert [result['reused'] for result in results] == [True, False]
+    assert attachments(fake_airtable, 'recGroupA') == 1
+    assert attachments(fake_airtable, 'recGroupB') == 1
+    assert handler.get_packing_list_fingerprint(s3_client, 'recGroupA')['attached'] is True
+
+
+def test_modified_records_are_paged_under_the_rate_limit(fake_airtable, s3_client, monkeypatch):
+    tables = shipment_groups('recGroupA')
+    for index in range(800):
+        tables['DomesticShipmentLineItem']['recBulk{}'.format(index)] = {'ShipQuantity': index}
+    fake_airtable.load(tables)
+    monkeypatch.setattr(fake_airtable, 'rate_limit', 5)
+    monkeypatch.setattr(handler, 'airtable_rate_limiter', handler.RateLimiter(5))
+
+    table = handler.airtable_table(handler.os.getenv('AIRTABLE_APP_ID'), 'DomesticShipmentLineItem', handler.os.getenv('AIRTABLE_SECRET_KEY'))
+    with handler.ThreadPoolExecutor(max_workers=1) as executor:
+        records = handler.request_modified_records(executor, table, time.time() - 60, handler.CHANGE_FEED_MAX_RECORDS).result()
+    assert len(records) == 801
+    assert fake_airtable.throttled == 0
@@ -0,0 +1,112 @@
+import time
+import zipfile
+from io import BytesIO
+
+import handler
+
+
+def shipment_groups(*group_ids):
+    # shipment groups of one line item each, all linking the same SKU, packaging profile and FC
+    tables = {
+        'ShipmentGroup': {},
+        'Domestic Shipments': {},
+        'DomesticShipmentLineItem': {},
+        'SKUS': {'recSku': {'SKU': 'SKU-1', 'FNSKU': 'OLD-FNSKU'}},
+        'PackagingProfile': {'recProfile': {'UnitsPerCarton': 10, 'CartonLengthCM': 40, 'CartonWidthCM': 30, 'CartonHeightCM': 20, 'CartonWeightKG': 5}},
+        'FCList': {'recFc': {'FCID': 'FC1', 'FCAddress': '1 Warehouse Road, Fulfillment City', 'FacilityCountry': 'US'}}
+    }
+    for group_id in group_ids:
+        tables['ShipmentGroup'][group_id] = {'DomesticShipments': [group_id + 'Shipment'], 'Cosignee Name': 'ACME', 'PackingLists Generated': []}
+        tables['Domestic Shipments'][group_id + 'Shipment'] = {
+            'FCID': ['recFc'],
+            'LineItems': [group_id + 'LineItem'],
+            'FBA Shipment ID': 'FBA' + group_id,
+            'AMZReferenceID': 'REF' + group_id
+        }
+        tables['DomesticShipmentLineItem'][group_id + 'LineItem'] = {
+            'SKU': ['recSku'], 'PackagingProfile': ['recProfile'], 'CaseQty': 2, 'ShipQuantity': 20, 'BoxMark': 'BM'
+        }
+    return tables
+
+
+def workbook_text(s3_client, download):
+    data = s3_client.objects[(handler.os.getenv('BUCKET_NAME'), download.rsplit('/', 1)[1])]
+    with zipfile.ZipFile(BytesIO(data)) as workbook:
+        return ''.join(workbook.read(name).decode('utf-8') for name in workbook.namelist() if name.endswith('.xml'))
+
+
+def test_cached_records_count_from_when_they_were_fetched(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA', 'recGroupB'), modified=time.time() - 3600)
+
+    # group A puts the SKU into the reference cache, then the SKU changes
+    handler.generate_packaging_list(s3_client, 'recGroupA')
+    fake_airtable.update('SKUS', 'recSku', {'FNSKU': 'NEW-FNSKU'})
+    # past the clock skew margin, the timestamps of the fake have a resolution of one second
+    time.sleep(2.5)
+
+    # group B is rendered from the cached SKU, its fingerprint has to count from when that was fetched
+    download, reused = handler.generate_packaging_list(s3_client, 'recGroupB')
+    assert 'OLD-FNSKU' in workbook_text(s3_client, download)
+    fingerprint = handler.get_packing_list_fingerprint(s3_client, 'recGroupB')
+    assert fingerprint['referencesChecked'] < time.time() - 2.5
+
+    download, reused = handler.generate_packaging_list(s3_client, 'recGroupB')
+    assert not reused
+    assert 'NEW-FNSKU' in workbook_text(s3_client, download)
+
+
+def test_fetched_records_count_from_the_fetch(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA'), modified=time.time() - 3600)
+
+    started = time.time()
+    handler.generate_packaging_list(s3_client, 'recGroupA')
+    assert handler.get_packing_list_fingerprint(s3_client, 'recGroupA')['checked'] >= started
+    download, reused = handler.generate_packaging_list(s3_client, 'recGroupA')
+    assert reused
+
+
+def test_batch_fingerprints_list_their_records(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA', 'recGroupB'), modified=time.time() - 3600)
+
+    handler.generate_packaging_list(s3_client, 'recGroupA')
+    started = time.time()
+    handler.create_batch({'body': handler.json.dumps({'recordIds': ['recGroupA', 'recGroupB'], 'force': True})}, None)
+    for group_id in ('recGroupA', 'recGroupB'):
+        fingerprint = handler.get_packing_list_fingerprint(s3_client, group_id)
+        assert fingerprint['records'] == sorted([group_id, group_id + 'Shipment', group_id + 'LineItem', 'recSku', 'recProfile', 'recFc'])
+    # the batch served the reference records from the cache filled by group A
+    assert fingerprint['referencesChecked'] < started
+
+
+def test_precheck_moves_checked_forward(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA'), modified=time.time() - 3600)
+
+    handler.generate_packaging_list(s3_client, 'recGroupA')
+    first = handler.get_packing_list_fingerprint(s3_client, 'recGroupA')
+    time.sleep(0.1)
+    download, reused = handler.generate_packaging_list(s3_client, 'recGroupA')
+    second = handler.get_packing_list_fingerprint(s3_client, 'recGroupA')
+    assert reused and download == first['download']
+    assert second['checked'] > first['checked']
+    assert second['fingerprint'] == first['fingerprint']
+
+
+def stages(s3_client, record_id):
+    started = []
+    handler.generate_packaging_list(s3_client, record_id, started.append)
+    return started
+
+
+def test_create_after_an_edit_only_prechecks(fake_airtable, s3_client):
+    fake_airtable.load(shipment_groups('recGroupA'), modified=time.time() - 3600)
+
+    handler.generate_packaging_list(s3_client, 'recGroupA')
+    for table_name, record_id, fields in [
+        ('DomesticShipmentLineItem', 'recGroupALineItem', {'ShipQuantity': 30}),
+        ('SKUS', 'recSku', {'FNSKU': 'NEW-FNSKU'})
+    ]:
+        fake_airtable.update(table_name, record_id, fields)
+        # past the clock skew margin, so the precheck after the next fetch no longer sees the edit
+        time.sleep(2.5)
+        assert 'fetch' in stages(s3_client, 'recGroupA')
+        assert stages(s3_client, 'recGroupA') == ['precheck']
@@ -0,0 +1,54 @@
+import multiprocessing
+import time
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import handler
+from fake_airtable import build_shipment_group
+
+GROUP_ID = 'recShipmentGroup'
+
+
+def fail_first(index):
+    # a worker of run_in_processes: the first one fails, the others would run for a long time
+    if index == 0:
+        raise ValueError('shard failed')
+    time.sleep(30)
+
+
+@pytest.mark.parametrize('line_items, shards, expected', [
+    ([100] * 40, 4, [(0, 10), (10, 20), (20, 30), (30, 40)]),
+    ([100, 1, 1, 1], 4, [(0, 1), (1, 2), (2, 3), (3, 4)]),
+    ([5, 5, 5], 8, [(0, 1), (1, 2), (2, 3)]),
+    ([3000] * 4, 1, [(0, 2), (2, 4)]),
+    ([], 4, [])
+])
+def test_shards(line_items, shards, expected):
+    domestic_shipments = [handler.DomesticShipment('recShipment{}'.format(index)) for index in range(len(line_items))]
+    for domestic_shipment, count in zip(domestic_shipments, line_items):
+        domestic_shipment.line_items = [None] * count
+    assert handler.shard_domestic_shipments(domestic_shipments, 5000, shards) == expected
+
+
+def test_every_worker_gets_a_shard(fake_airtable, s3_client, monkeypatch):
+    monkeypatch.setattr(handler, 'RENDER_MAX_WORKERS', 3)
+    fake_airtable.load(build_shipment_group(5, 4, skus=7, facilities=3))
+    download, reused = handler.generate_packaging_list(s3_client, GROUP_ID, output_format='zip')
+    assert handler.metrics.as_dict()['counters']['shards'] == 3
+
+    data = s3_client.objects[(handler.os.getenv('BUCKET_NAME'), download.rsplit('/', 1)[1])]
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        names = sorted(archive.namelist())
+    assert names == ['{} FBA{:08d}.xlsx'.format(index + 1, index) for index in range(5)] + ['Summary.xlsx']
+
+
+def test_stopping_early_terminates_the_workers():
+    started = time.monotonic()
+    results = handler.run_in_processes(fail_first, [(index,) for index in range(3)], max_workers=3)
+    index, ok, result = next(results)
+    results.close()
+    assert (index, ok, result) == (0, False, 'shard failed')
+    assert not multiprocessing.active_children()
+    assert time.monotonic() - started < 10
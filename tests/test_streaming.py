@@ -0,0 +1,128 @@
+import pytest
+
+import handler
+from fake_airtable import build_shipment_group
+
+GROUP_ID = 'recShipmentGroup'
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # a few records per request and request in flight, so the small test groups span many of them
+    monkeypatch.setattr(handler, 'RECORD_ID_CHUNK_SIZE', 3)
+    monkeypatch.setattr(handler, 'STREAM_PREFETCH_CHUNKS', 2)
+
+
+def streamed(shipment_group_id=GROUP_ID):
+    try:
+        shipment_group, domestic_shipments = handler.stream_shipment_group_from_airtable('appTest', 'keyTest', shipment_group_id)
+        yielded = [domestic_shipment.as_dict() for domestic_shipment in domestic_shipments]
+    except ValueError as e:
+        return 'error', str(e)
+    assert yielded == [domestic_shipment.as_dict() for domestic_shipment in shipment_group.domestic_shipments]
+    return 'ok', shipment_group.as_dict()
+
+
+def fetched_at_once(shipment_group_id=GROUP_ID):
+    shipment_groups, errors = handler.get_shipment_groups_from_airtable('appTest', 'keyTest', [shipment_group_id])
+    if shipment_group_id in errors:
+        return 'error', 'Error getting domestic shipments from Airtable: ' + errors[shipment_group_id]
+    return 'ok', shipment_groups[shipment_group_id].as_dict()
+
+
+def assert_same_as_fetched_at_once(fake_airtable):
+    expected = fetched_at_once()
+    handler.reference_cache.invalidate()
+    assert streamed() == expected
+    # and once more with the reference records cached
+    assert streamed() == expected
+    return expected
+
+
+def test_group(fake_airtable):
+    fake_airtable.load(build_shipment_group(4, 5, skus=7, facilities=3))
+    status, shipment_group = assert_same_as_fetched_at_once(fake_airtable)
+    assert status == 'ok'
+    assert len(shipment_group['domestic_shipments']) == 4
+
+
+def test_line_item_shared_by_shipments(fake_airtable):
+    tables = build_shipment_group(3, 4, skus=5)
+    tables['Domestic Shipments']['recShipment2']['LineItems'].insert(1, 'recLineItem0_0')
+    fake_airtable.load(tables)
+    assert assert_same_as_fetched_at_once(fake_airtable)[0] == 'ok'
+
+
+def test_shipment_listed_twice(fake_airtable):
+    tables = build_shipment_group(3, 4, skus=5)
+    tables['ShipmentGroup'][GROUP_ID]['DomesticShipments'].append('recShipment0')
+    fake_airtable.load(tables)
+    status, shipment_group = assert_same_as_fetched_at_once(fake_airtable)
+    assert [domestic_shipment['id'] for domestic_shipment in shipment_group['domestic_shipments']] == [
+        'recShipment0', 'recShipment1', 'recShipment2', 'recShipment0'
+    ]
+
+
+def test_shipment_without_fulfillment_center(fake_airtable):
+    tables = build_shipment_group(3, 4, skus=5)
+    del tables['Domestic Shipments']['recShipment1']['FCID']
+    fake_airtable.load(tables)
+    status, shipment_group = assert_same_as_fetched_at_once(fake_airtable)
+    assert shipment_group['domestic_shipments'][1]['fulfillment_center']['id'] is None
+
+
+def test_deleted_line_item(fake_airtable):
+    tables = build_shipment_group(3, 4, skus=5)
+    del tables['DomesticShipmentLineItem']['recLineItem1_2']
+    fake_airtable.load(tables)
+    status, message = assert_same_as_fetched_at_once(fake_airtable)
+    assert status == 'error'
+    assert 'recLineItem1_2' in message
+
+
+def test_no_more_requests_than_fetching_at_once(fake_airtable):
+    fake_airtable.load(build_shipment_group(10, 10, skus=40))
+    fetched_at_once()
+    requests_at_once = sum(fake_airtable.requests.values())
+    handler.reference_cache.invalidate()
+    fake_airtable.reset_counters()
+    streamed()
+    assert sum(fake_airtable.requests.values()) <= requests_at_once
+
+
+def test_stopping_early_cancels_the_remaining_requests(fake_airtable):
+    fake_airtable.load(build_shipment_group(20, 10, skus=40))
+    shipment_group, domestic_shipments = handler.stream_shipment_group_from_airtable('appTest', 'keyTest', GROUP_ID)
+    first = next(domestic_shipments)
+    domestic_shipments.close()
+    assert first.id == 'recShipment0'
+    assert [domestic_shipment.id for domestic_shipment in shipment_group.domestic_shipments] == ['recShipment0']
+    assert 'fetch' not in handler.metrics.as_dict()['timings_ms']
+    # nothing near all 200 line items in 67 chunks was requested
+    assert fake_airtable.requests['GET DomesticShipmentLineItem'] < 10
+
+
+def test_exports_stream_when_there_is_an_earlier_one(fake_airtable, s3_client, monkeypatch):
+    fake_airtable.load(build_shipment_group(4, 5, skus=7, facilities=3))
+    download, reused = handler.generate_packaging_list(s3_client, GROUP_ID, output_format='csv')
+
+    generate_export_file = handler.generate_export_file
+    streams = []
+
+    def spy(*args, **kwargs):
+        streams.append(kwargs['domestic_shipments'])
+        return generate_export_file(*args, **kwargs)
+
+    monkeypatch.setattr(handler, 'generate_export_file', spy)
+    # modified without a change, the precheck fails and the export is compared once it is written
+    fake_airtable.update('DomesticShipmentLineItem', 'recLineItem0_0', {})
+    objects = set(s3_client.objects)
+    assert handler.generate_packaging_list(s3_client, GROUP_ID, output_format='csv') == (download, True)
+    assert streams[0] is not None
+    assert set(s3_client.objects) == objects
+    assert not s3_client.uploads
+
+    fake_airtable.update('DomesticShipmentLineItem', 'recLineItem0_0', {'ShipQuantity': 987654})
+    changed, reused = handler.generate_packaging_list(s3_client, GROUP_ID, output_format='csv')
+    assert not reused
+    assert b'987654' in s3_client.objects[(handler.os.getenv('BUCKET_NAME'), changed.rsplit('/', 1)[1])]
@@ -0,0 +1,40 @@
+import handler
+from fake_s3 import FakeS3Client
+
+
+class RecordingS3Client(FakeS3Client):
+    # keeps the bodies it was given as they are
+    def __init__(self):
+        FakeS3Client.__init__(self)
+        self.bodies = []
+
+    def put_object(self, Body, **kwargs):
+        self.bodies.append(Body)
+        return FakeS3Client.put_object(self, Body=Body, **kwargs)
+
+    def upload_part(self, Body, **kwargs):
+        self.bodies.append(Body)
+        return FakeS3Client.upload_part(self, Body=Body, **kwargs)
+
+
+def test_small_files_are_put_from_the_buffer():
+    s3_client = RecordingS3Client()
+    upload = handler.S3MultipartUpload(s3_client, 'bucket', 'key', part_size=10)
+    upload.write(b'abc')
+    upload.write(b'def')
+    buffer = upload.buffer
+    upload.close()
+    assert s3_client.bodies == [b'abcdef'] and s3_client.bodies[0] is buffer
+    assert s3_client.objects[('bucket', 'key')] == b'abcdef'
+
+
+def test_parts_are_sent_from_the_buffer():
+    s3_client = RecordingS3Client()
+    upload = handler.S3MultipartUpload(s3_client, 'bucket', 'key', part_size=10)
+    buffer = upload.buffer
+    upload.write(b'0123456')
+    upload.write(b'789abcdefghijklmnopqrstuvw')
+    upload.close()
+    assert s3_client.bodies[0] is buffer
+    assert s3_client.bodies == [b'0123456789', b'abcdefghij', b'klmnopqrst', b'uvw']
+    assert s3_client.objects[('bucket', 'key')] == b'0123456789abcdefghijklmnopqrstuvw'